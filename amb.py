@@ -1,5 +1,9 @@
 #!/usr/bin/env python
+import sys
+import time
 import random
+from collections import deque
+from multiprocessing import cpu_count, Pool
 
 from progress import Progress
 
@@ -9,7 +13,7 @@ class Runner(object):
         self.func = func
         self.options = []
         self.choices = []
-        self.progress = Progress(report_rate=1)
+        self.progress = Progress(name='Runner', report_rate=1)
 
     def run(self, *args):
         while True:
@@ -54,11 +58,252 @@ class Runner(object):
             self.choices[-1] += 1
 
 
+class TrailRunner(object):
+    """
+    Runner that keeps its choice points on a trail updated in place.
+
+    Searches in the same order (with the same results) as Runner.  The function is still
+    re-run after a Fail (see ContinuationRunner for functions that avoid that), but
+    replaying the trail is made as cheap as possible: each amb call during replay just returns the
+    value stored for it, and backtracking only pops exhausted choice points (no lists
+    are copied).
+    """
+    def __init__(self, func):
+        self.func = func
+        # Parallel stacks, one entry per choice point: the index chosen, the number of
+        # options, the options (None for amb(n)) and the value returned.
+        self.choices = []
+        self.sizes = []
+        self.options = []
+        self.values = []
+        self.progress = Progress(name='TrailRunner', report_rate=1)
+
+    def run(self, *args):
+        while True:
+            try:
+                self.progress.report(self.choices)
+                self.restart()
+                result = self.func(self.amb, *args)
+                break
+            except Fail:
+                self.backtrack()
+        self.progress.report(self.choices, final=True)
+        return result
+
+    def restart(self):
+        """ Get ready to (re-)run the function from the start of the trail. """
+        self.call_number = 0
+
+    def amb(self, choices=None):
+        call_number = self.call_number
+        self.call_number = call_number + 1
+        if call_number < len(self.values):
+            return self.values[call_number]
+
+        if choices is None:
+            choices = (False, True)
+        if isinstance(choices, (int, long)):
+            size = choices
+            choices = None
+        else:
+            size = len(choices)
+        if size <= 0:
+            raise Fail
+        self.choices.append(0)
+        self.sizes.append(size)
+        self.options.append(choices)
+        value = 0 if choices is None else choices[0]
+        self.values.append(value)
+        return value
+
+    def backtrack(self):
+        """ Advance to the next choice at the deepest choice point that has one. """
+        choices = self.choices
+        while choices:
+            choice = choices[-1] + 1
+            if choice < self.sizes[-1]:
+                choices[-1] = choice
+                options = self.options[-1]
+                self.values[-1] = choice if options is None else options[choice]
+                return
+            choices.pop()
+            self.sizes.pop()
+            self.options.pop()
+            self.values.pop()
+        raise Fail
+
+
+class ContinuationRunner(object):
+    """
+    Runner for functions written in continuation-passing style - so a Fail re-runs only
+    the code after the last choice point, and nothing is replayed.
+
+    Instead of returning a value, amb(choices, then) calls then(value) - the rest of the
+    function after the choice point - with each choice in turn, and returns the first
+    result that does not Fail:
+
+        def pair(amb, total):
+            return amb(10, lambda x: amb(10, lambda y: check(x, y, total)))
+
+    Choices are as for Runner (None for False/True, a list, or a count) and are tried in
+    the same order, so the results are the same.  The values chosen so far are kept in
+    values (for progress reports).
+    """
+    def __init__(self, func):
+        self.func = func
+        self.values = []
+        self.progress = Progress(name='ContinuationRunner', report_rate=1)
+
+    def run(self, *args):
+        del self.values[:]
+        result = self.func(self.amb, *args)
+        self.progress.report(self.values, final=True)
+        return result
+
+    def amb(self, choices, then):
+        if choices is None:
+            choices = (False, True)
+        elif isinstance(choices, (int, long)):
+            choices = xrange(choices)
+        values = self.values
+        for value in choices:
+            self.progress.report(values)
+            values.append(value)
+            try:
+                return then(value)
+            except Fail:
+                pass
+            finally:
+                values.pop()
+        raise Fail
+
+
+class ConstraintRunner(TrailRunner):
+    """
+    TrailRunner that checks constraints between named choice points as they are bound.
+
+    Choice points are named by amb(choices, name=...).  When a named choice point is
+    reached, its options are narrowed to the values that every constraint on the name
+    still allows, given the names bound so far (forward checking) - so values that
+    could only lead to a Fail are never tried.  No options left is a Fail.  The number
+    of options removed is counted in pruned.
+
+        runner = ConstraintRunner(func, [AllDifferent('abc'), SumBetween('abc', high=10)])
+    """
+    def __init__(self, func, constraints=()):
+        super(ConstraintRunner, self).__init__(func)
+        self.progress.name = 'ConstraintRunner'
+        self.constraints = []
+        self.watching = {}
+        self.bound = {}
+        self.pruned = 0
+        for constraint in constraints:
+            self.add_constraint(constraint)
+
+    def add_constraint(self, constraint):
+        self.constraints.append(constraint)
+        for name in constraint.names:
+            self.watching.setdefault(name, []).append(constraint)
+
+    def restart(self):
+        super(ConstraintRunner, self).restart()
+        self.bound = {}
+
+    def amb(self, choices=None, name=None):
+        if name is None:
+            return super(ConstraintRunner, self).amb(choices)
+        if self.call_number >= len(self.values):
+            if choices is None:
+                choices = (False, True)
+            elif isinstance(choices, (int, long)):
+                choices = range(choices)
+            constraints = self.watching.get(name, ())
+            options = [value for value in choices
+                       if all(constraint.allows(name, value, self.bound) for constraint in constraints)]
+            self.pruned += len(choices) - len(options)
+            choices = options
+        value = super(ConstraintRunner, self).amb(choices)
+        self.bound[name] = value
+        return value
+
+
+class AllDifferent(object):
+    """ The named choices all differ (or all differ in key(name, value)). """
+    def __init__(self, names, key=None):
+        self.names = list(names)
+        self.key = key
+
+    def allows(self, name, value, bound):
+        key = self.key
+        if key is None:
+            return all(bound[other] != value for other in self.names if other in bound and other != name)
+        value = key(name, value)
+        return all(key(other, bound[other]) != value
+                   for other in self.names if other in bound and other != name)
+
+
+class SumBetween(object):
+    """
+    The named choices add up to between low and high (either may be None).  Choices not
+    yet bound are assumed to be between lowest and highest (None is unbounded).
+    """
+    def __init__(self, names, low=None, high=None, lowest=0, highest=None):
+        self.names = list(names)
+        self.low = low
+        self.high = high
+        self.lowest = lowest
+        self.highest = highest
+
+    def allows(self, name, value, bound):
+        total = value
+        unbound = 0
+        for other in self.names:
+            if other == name:
+                continue
+            if other in bound:
+                total += bound[other]
+            else:
+                unbound += 1
+        if self.high is not None and (unbound == 0 or self.lowest is not None):
+            if total + unbound * (self.lowest or 0) > self.high:
+                return False
+        if self.low is not None and (unbound == 0 or self.highest is not None):
+            if total + unbound * (self.highest or 0) < self.low:
+                return False
+        return True
+
+
+class Predicate(object):
+    """ test(*values) holds for the named choices (checked once they are all bound). """
+    def __init__(self, names, test):
+        self.names = list(names)
+        self.test = test
+
+    def allows(self, name, value, bound):
+        values = []
+        for other in self.names:
+            if other == name:
+                values.append(value)
+            elif other in bound:
+                values.append(bound[other])
+            else:
+                return True
+        return self.test(*values)
+
+
 class MonteCarloRunner(object):
+    """
+    Try random choices until func succeeds.
+
+    run_parallel() samples in a process Pool instead (func must then be picklable - i.e.,
+    defined at module level).
+    """
     def __init__(self, func):
         self.func = func
-        self.progress = Progress(report_rate=1)
+        self.progress = Progress(name='MonteCarloRunner', report_rate=1)
         self.choices = []
+        self.random = random
+        self.stats = None
 
     def run(self, *args):
         while True:
@@ -81,10 +326,73 @@ class MonteCarloRunner(object):
             size = len(choices)
         if size <= 0:
             raise Fail
-        value = random.randrange(size)
+        value = self.random.randrange(size)
         self.choices.append(value)
         return value
 
+    def run_parallel(self, args=(), solutions=1, workers=None, seed=None, batch=1000):
+        """
+        Sample in batches of trials across a process Pool and return a list of the first
+        solutions results (in batch order).
+
+        Batch i draws its choices from random.Random(seed * 2**32 + i), so a given seed
+        always finds the same solutions.  Trial counts and rates are left in self.stats.
+        """
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(32)
+        worker_count = workers if workers is not None else cpu_count()
+        pool = Pool(worker_count)
+        pending = deque()
+        results = []
+        trials = 0
+        batches = 0
+        start_time = time.time()
+        try:
+            while len(results) < solutions:
+                while len(pending) < 2 * worker_count:
+                    pending.append(pool.apply_async(monte_carlo_batch,
+                                                    (self.func, args, seed * 2 ** 32 + batches,
+                                                     batch, solutions)))
+                    batches += 1
+                batch_trials, found = pending.popleft().get()
+                trials += batch_trials
+                results.extend(found[:solutions - len(results)])
+                self.progress.report("%d found" % len(results), count=batch_trials)
+        finally:
+            pool.terminate()
+            pool.join()
+        elapsed = time.time() - start_time
+        self.progress.report("%d found" % len(results), final=True)
+
+        self.stats = {'seed': seed,
+                      'workers': worker_count,
+                      'trials': trials,
+                      'solutions': len(results),
+                      'success_rate': float(len(results)) / trials if trials else 0.0,
+                      'elapsed': elapsed,
+                      'trials_per_sec': trials / elapsed if elapsed > 0 else 0.0,
+                      }
+        sys.stderr.write("{trials:,d} trials on {workers:d} workers (seed {seed:d}): "
+                         "{trials_per_sec:,.0f} trials/sec, "
+                         "success rate {success_rate:.3g}\n".format(**self.stats))
+        return results
+
+
+def monte_carlo_batch(func, args, seed, trials, solutions):
+    """ Pool task: (trials run, results) for up to trials random tries of func. """
+    runner = MonteCarloRunner(func)
+    runner.random = random.Random(seed)
+    results = []
+    for trial in xrange(1, trials + 1):
+        runner.choices = []
+        try:
+            results.append(func(runner.amb, *args))
+        except Fail:
+            continue
+        if len(results) == solutions:
+            return trial, results
+    return trials, results
+
 
 class Fail(Exception):
     pass
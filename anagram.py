@@ -2,71 +2,609 @@
 # anagram.py - Prints anagrams of word passed in command line.
 from __future__ import print_function
 
+import os
+import sys
+import json
+import time
+import signal
 import argparse
+import threading
+from collections import OrderedDict, deque
+from multiprocessing import cpu_count, Pool
+from itertools import combinations_with_replacement, product
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
 
 
 DICT_FILE = 'dict.txt'
+INDEX_VERSION = 1
+
+# A prime for each letter - the most frequent letters get the smallest.
+LETTER_PRIMES = dict(zip('etaoinshrdlcumwfgypbvkjxqz',
+                         (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71,
+                          73, 79, 83, 89, 97, 101)))
+PRIMES = sorted(LETTER_PRIMES.values())
 
 
 def main():
     parser = argparse.ArgumentParser(description='Print anagrams of word on command line.')
     parser.add_argument("words", type=str, nargs='*', help="Word(s) to anagram.")
+    parser.add_argument("--dict", default=DICT_FILE,
+                        help="Dictionary (one word per line).")
+    parser.add_argument("--index",
+                        help="Signature index file (default <dict>.index - built when missing or "
+                             "out of date).")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Rebuild the index even if it is up to date.")
+    parser.add_argument("--max-words", default=10, type=int,
+                        help="Most words in an anagram.")
+    parser.add_argument("--limit", type=int,
+                        help="Stop after this many anagrams.")
+    parser.add_argument("--timeout", type=float,
+                        help="Stop after this many seconds.")
+    parser.add_argument("--serve", action="store_true",
+                        help="Answer queries (JSON lines - see AnagramServer) from stdin.")
+    parser.add_argument("--socket",
+                        help="Answer queries on this Unix socket.")
+    parser.add_argument("--workers", type=int,
+                        help="Processes answering queries (default: one per core) - or searching "
+                             "(default: just this one).")
+    parser.add_argument("--cache-size", default=0, type=int,
+                        help="List the anagrams by number of words (rather than as they are found), "
+                             "remembering this many sub-results (see SubresultCache).")
     args = parser.parse_args()
+    if args.cache_size > 0 and (args.limit is not None or args.timeout is not None or args.workers):
+        parser.error("--cache-size lists every anagram in this process (no --limit, --timeout or --workers).")
+
+    index = AnagramIndex.load(args.dict, args.index, rebuild=args.rebuild)
+    if args.serve or args.socket:
+        server = AnagramServer(index, args.workers,
+                               dict(max_words=args.max_words, limit=args.limit, timeout=args.timeout))
+        try:
+            if args.socket:
+                server.serve_socket(args.socket)
+            else:
+                server.serve_lines(sys.stdin, sys.stdout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            sys.stderr.write(server.format_stats() + "\n")
+        return
+
+    phrase = signature(' '.join(args.words))
+    candidates = index.candidates(phrase)
 
-    counts = LetterCounts()
-    for word in args.words:
-        counts.add_word(word)
+    print("%d candidate words in dictionary (out of %d)" %
+          (sum(len(index.groups[sig]) for sig in candidates), len(index.words)))
 
-    words = list()
+    if args.cache_size > 0:
+        cache = SubresultCache(args.cache_size)
+        number = 1
+        for use_words in range(1, args.max_words + 1):
+            print("Anagrams of %d words..." % use_words)
+            anagrams = index.anagrams(phrase, use_words, candidates, cache)
+            for i, anagram in enumerate(anagrams):
+                print("%2d. %s" % (number + i, ' '.join(anagram)))
+            number += len(anagrams)
+        sys.stderr.write("Cache: {hit_rate:.1%} hits ({hits:,d} of {lookups:,d}), {entries:,d} entries, "
+                         "peak {peak_kb:,.0f} KB\n".format(**cache.get_stats()))
+        return
 
-    total_words = 0
-    with open(DICT_FILE) as f:
-        for line in f.readlines():
-            word = line.strip()
-            total_words += 1
-            if counts.contains(word):
-                words.append(word)
+    start = time.time()
+    number = 0
+    for number, anagram in enumerate(index.iter_anagrams(phrase, args.max_words, args.limit, args.timeout,
+                                                         candidates, args.workers), 1):
+        print("%2d. %s" % (number, ' '.join(anagram)))
+    sys.stderr.write("{:,d} anagrams in {:.2f} secs\n".format(number, time.time() - start))
 
-    print("%d candidate words in dictionary (out of %d)" % (len(words), total_words))
 
-    index = 1
-    for use_words in range(1, 11):
-        print("Anagrams of %d words..." % use_words)
-        anagrams = find_anagrams(use_words, counts, words)
-        for i, anagram in enumerate(anagrams):
-            print("%2d. %s" % (index + i, ' '.join(anagram)))
-        index += len(anagrams)
+def signature(word):
+    """ Product of the primes of the letters in word (1 if there are none). """
+    sig = 1
+    for ch in word.lower():
+        prime = LETTER_PRIMES.get(ch)
+        if prime is not None:
+            sig *= prime
+    return sig
 
 
-def find_anagrams(use_words, counts, words, start=0):
+def letter_count(word):
+    return sum(1 for ch in word.lower() if ch in LETTER_PRIMES)
+
+
+class AnagramIndex(object):
     """
-    Return array of anagrams that can by made from
-    words[start:]
+    The words of a dictionary grouped by signature (see signature) - words are anagrams
+    of each other exactly when their signatures are equal, and a word can be made from the
+    letters of a phrase when its signature divides the phrase's.
+
+    The index is saved as JSON (next to the dictionary by default) and rebuilt when the
+    dictionary changes.  Signatures are kept longest word first.
+    """
+    def __init__(self, words, source=None):
+        self.words = words
+        self.source = source
+        # Signature -> indices (in words) of its words.
+        self.groups = {}
+        for i, word in enumerate(words):
+            sig = signature(word)
+            if sig != 1:
+                self.groups.setdefault(sig, []).append(i)
+        self.lengths = dict((sig, letter_count(words[group[0]])) for sig, group in self.groups.items())
+        self.signatures = sorted(self.groups, key=lambda sig: (-self.lengths[sig], self.groups[sig][0]))
+
+    @classmethod
+    def build(cls, dict_file):
+        with open(dict_file) as f:
+            words = [line.strip() for line in f]
+        return cls(words, source=file_stamp(dict_file))
+
+    @classmethod
+    def load(cls, dict_file=DICT_FILE, index_file=None, rebuild=False):
+        """ Load the index for dict_file - building (and saving) it if need be. """
+        if index_file is None:
+            index_file = dict_file + '.index'
+        if not rebuild and os.path.exists(index_file):
+            with open(index_file) as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION and data.get('source') == file_stamp(dict_file):
+                return cls.from_data(data)
+        index = cls.build(dict_file)
+        index.save(index_file)
+        return index
+
+    @classmethod
+    def from_data(cls, data):
+        index = cls.__new__(cls)
+        index.words = data['words']
+        index.source = data['source']
+        index.signatures = [sig for sig, length, group in data['groups']]
+        index.lengths = dict((sig, length) for sig, length, group in data['groups'])
+        index.groups = dict((sig, group) for sig, length, group in data['groups'])
+        return index
+
+    def save(self, index_file):
+        data = {'version': INDEX_VERSION,
+                'source': self.source,
+                'words': self.words,
+                'groups': [[sig, self.lengths[sig], self.groups[sig]] for sig in self.signatures],
+                }
+        temp_name = index_file + '.tmp'
+        with open(temp_name, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(temp_name, index_file)
+
+    def candidates(self, phrase):
+        """ Signatures (longest first) of the words that can be made from phrase (a signature). """
+        return [sig for sig in self.signatures if phrase % sig == 0]
+
+    def anagrams(self, phrase, use_words, candidates=None, cache=None):
+        """
+        Return the anagrams of phrase (a signature) of use_words words - each a list of
+        words in dictionary order, and in dictionary order of their words.
+        """
+        if candidates is None:
+            candidates = self.candidates(phrase)
+        anagrams = []
+        for sigs in find_anagrams(use_words, phrase, candidates, self.lengths, cache=cache):
+            anagrams.extend(self.expand(sigs))
+        anagrams.sort()
+        return [[self.words[i] for i in anagram] for anagram in anagrams]
+
+    def iter_anagrams(self, phrase, max_words=10, limit=None, timeout=None, candidates=None, workers=None):
+        """
+        Generate the anagrams of phrase (a signature) of up to max_words words, as they are
+        found (see iter_signatures) - stopping after limit of them or timeout seconds.  With
+        workers, the search is split across that many processes (see
+        iter_signatures_parallel) - same anagrams, same order.
+        """
+        if candidates is None:
+            candidates = self.candidates(phrase)
+        deadline = None if timeout is None else time.time() + timeout
+        if workers is not None and workers > 1:
+            signatures = iter_signatures_parallel(phrase, candidates, self.lengths, max_words, workers, deadline)
+        else:
+            signatures = iter_signatures(phrase, candidates, self.lengths, max_words, deadline=deadline)
+        count = 0
+        for sigs in signatures:
+            for anagram in self.expand(sigs):
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield [self.words[i] for i in anagram]
+
+    def expand(self, sigs):
+        """ Every choice of words (as sorted index tuples) for a list of signatures. """
+        choices = []
+        for sig in sorted(set(sigs)):
+            choices.append(combinations_with_replacement(self.groups[sig], sigs.count(sig)))
+        for choice in product(*choices):
+            yield tuple(sorted(i for group in choice for i in group))
+
+
+def file_stamp(file_name):
+    """ [size, modification time] of a file - to tell when an index is out of date. """
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime]
+
+
+def find_anagrams(use_words, phrase, candidates, lengths, length=None, cache=None):
+    """
+    Return a list of the ways (lists of signatures, in candidates order - a signature
+    may repeat) to make exactly the letters of phrase from use_words words.  candidates
+    are the signatures dividing phrase, longest first; lengths their letter counts.
+
+    The same remaining letters come up through different choices of earlier words.  With
+    a cache (SubresultCache), the ways to make them are remembered by (words left,
+    remaining letters' signature): the sub-search then runs over every candidate (not
+    just those from the current one on), so the result does not depend on how the
+    letters were reached - and the ways starting before the current candidate are
+    skipped when it is used.
     """
     anagrams = []
     if use_words <= 0:
         return anagrams
+    if use_words == 1:
+        return [[phrase]] if phrase in candidates else anagrams
+    if length is None:
+        length = signature_length(phrase)
+    if cache is not None:
+        positions = dict((sig, i) for i, sig in enumerate(candidates))
 
-    for i in range(start, len(words)):
-        if not counts.contains(words[i]):
+    for i, sig in enumerate(candidates):
+        # Candidates only get shorter - stop when use_words of them can't cover the phrase.
+        if lengths[sig] * use_words < length:
+            break
+        rest = phrase // sig
+        if rest == 1:
             continue
-
-        sub_counts = counts.clone()
-        sub_counts.subtract_word(words[i])
-        if sub_counts.is_zero():
-            if use_words == 1:
-                anagrams.append([words[i]])
+        if cache is None:
+            sub_candidates = [sub for sub in candidates[i:] if rest % sub == 0]
+            for sub_anagram in find_anagrams(use_words - 1, rest, sub_candidates, lengths,
+                                             length - lengths[sig]):
+                anagrams.append([sig] + sub_anagram)
             continue
 
-        sub_anagrams = find_anagrams(use_words - 1, sub_counts, words, i)
+        key = (use_words - 1, rest)
+        sub_anagrams = cache.get(key)
+        if sub_anagrams is None:
+            sub_candidates = [sub for sub in candidates if rest % sub == 0]
+            sub_anagrams = find_anagrams(use_words - 1, rest, sub_candidates, lengths, length - lengths[sig],
+                                         cache)
+            cache.put(key, sub_anagrams)
         for sub_anagram in sub_anagrams:
-            anagram = [words[i]]
-            anagram.extend(sub_anagram)
-            anagrams.append(anagram)
-
+            if positions[sub_anagram[0]] >= i:
+                anagrams.append([sig] + sub_anagram)
     return anagrams
 
 
+def iter_signatures(phrase, candidates, lengths, max_words, length=None, deadline=None):
+    """
+    Generate the ways (lists of signatures, in candidates order) to make exactly the
+    letters of phrase from 1 to max_words words - depth first, so each is yielded as soon
+    as it is found and only the current path is held.  Stops (early) at deadline (a
+    time.time() value).
+    """
+    if length is None:
+        length = signature_length(phrase)
+    for i, sig in enumerate(candidates):
+        if lengths[sig] * max_words < length:
+            break
+        if deadline is not None and time.time() > deadline:
+            return
+        rest = phrase // sig
+        if rest == 1:
+            yield [sig]
+            continue
+        if max_words == 1:
+            continue
+        sub_candidates = [sub for sub in candidates[i:] if rest % sub == 0]
+        for sub_sigs in iter_signatures(rest, sub_candidates, lengths, max_words - 1, length - lengths[sig],
+                                        deadline):
+            yield [sig] + sub_sigs
+
+
+def iter_signatures_parallel(phrase, candidates, lengths, max_words, workers=None, deadline=None):
+    """
+    iter_signatures, with the subtrees below the first words searched as tasks in a process
+    Pool.  Subtrees much bigger than average (by a rough count of their paths) are split by
+    second word, so the tasks - handed out in search order - are of similar sizes; each
+    task's results are yielded once it (and those before it) are done.  At most 2 tasks per
+    worker are handed out ahead of the one being yielded, so only their results are held.
+    """
+    worker_count = workers if workers is not None else cpu_count()
+    branches = split_branch([], phrase, candidates, lengths, max_words, signature_length(phrase))
+    target = sum(branch_size(branch) for branch in branches) / (4.0 * worker_count)
+    tasks = deque()
+    for branch in branches:
+        prefix, rest, sub_candidates, words, length = branch
+        if branch_size(branch) > target and words > 1:
+            tasks.extend(split_branch(prefix, rest, sub_candidates, lengths, words, length))
+        else:
+            tasks.append(branch)
+    # Dead ends (no candidates for the rest of the phrase) need no task.
+    tasks = deque(branch for branch in tasks if branch[1] == 1 or branch[2])
+
+    pool = Pool(worker_count, initializer=init_search_worker, initargs=(lengths,))
+    pending = deque()
+    try:
+        while tasks or pending:
+            while tasks and len(pending) < 2 * worker_count:
+                branch = tasks.popleft()
+                if branch[1] == 1:
+                    pending.append((branch[0], None))
+                else:
+                    pending.append((branch[0], pool.apply_async(search_branch, branch[1:] + (deadline,))))
+            prefix, result = pending.popleft()
+            if result is None:
+                yield prefix
+                continue
+            # (A timeout keeps the wait interruptible.)
+            for sub_sigs in result.get(1e6):
+                yield prefix + sub_sigs
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def split_branch(prefix, phrase, candidates, lengths, max_words, length):
+    """
+    The subtrees (prefix + [signature], rest of phrase, its candidates, max_words, length)
+    of iter_signatures(phrase, ...) - in order.  Rest is 1 for a complete anagram.
+    """
+    branches = []
+    for i, sig in enumerate(candidates):
+        if lengths[sig] * max_words < length:
+            break
+        rest = phrase // sig
+        if rest == 1:
+            branches.append((prefix + [sig], rest, [], 0, 0))
+        elif max_words > 1:
+            branches.append((prefix + [sig], rest, [sub for sub in candidates[i:] if rest % sub == 0],
+                             max_words - 1, length - lengths[sig]))
+    return branches
+
+
+def branch_size(branch):
+    """ Rough count of the paths in a subtree (see split_branch). """
+    return float(len(branch[2])) ** min(branch[3], 3)
+
+
+# Pool worker global (see init_search_worker).
+worker_lengths = None
+
+
+def init_search_worker(lengths):
+    global worker_lengths
+    worker_lengths = lengths
+
+
+def search_branch(phrase, candidates, max_words, length, deadline):
+    """ Pool task: list(iter_signatures(...)) for a subtree. """
+    return list(iter_signatures(phrase, candidates, worker_lengths, max_words, length, deadline))
+
+
+class SubresultCache(object):
+    """ find_anagrams sub-results - dropping the least recently used beyond max_entries. """
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.peak_bytes = 0
+
+    def get(self, key):
+        result = self.entries.pop(key, None)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = result
+        return result[0]
+
+    def put(self, key, value):
+        if key in self.entries:
+            return
+        size = sys.getsizeof(key) + sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+        while len(self.entries) >= self.max_entries:
+            old_key, old = self.entries.popitem(last=False)
+            self.bytes -= old[1]
+        self.entries[key] = (value, size)
+        self.bytes += size
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'lookups': lookups,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'peak_kb': self.peak_bytes / 1024.0,
+                }
+
+
+class AnagramServer(object):
+    """
+    Answers anagram queries with the index loaded once - in a process Pool, so queries
+    run concurrently.  A query is a JSON object:
+
+        {"id": 7, "phrase": "dormitory", "max_words": 3, "limit": 100, "timeout": 1.5}
+
+    (all but phrase optional - defaults as given) and is answered by one JSON line:
+
+        {"id": 7, "anagrams": ["dormitory", "dryrot mio", ...], "count": 568, "secs": 0.01}
+
+    or {"id": 7, "error": "..."}.  {"stats": true} is answered with latency_stats().
+    """
+    def __init__(self, index, workers=None, defaults=None):
+        global server_index
+        # Workers are forked with the index (rather than pickling it to each).
+        server_index = index
+        self.defaults = defaults or {}
+        # Workers leave interrupts (^C to stop serving) to the server.
+        self.pool = Pool(workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+        self.lock = threading.Lock()
+        self.latencies = []
+
+    def submit(self, query, callback):
+        """ Answer query (a dict) in the pool - calling callback(response) when done. """
+        received = time.time()
+
+        def answered(response):
+            response['secs'] = time.time() - received
+            with self.lock:
+                self.latencies.append(response['secs'])
+            callback(response)
+
+        if query.get('stats'):
+            callback(dict(self.latency_stats(), id=query.get('id')))
+            return
+        self.pool.apply_async(answer_query, (dict(self.defaults, **query),), callback=answered)
+
+    def answer(self, query):
+        """ Answer query (a dict) - waiting for the response. """
+        responses = []
+        done = threading.Event()
+
+        def answered(response):
+            responses.append(response)
+            done.set()
+
+        self.submit(query, answered)
+        # (A timeout keeps the wait interruptible.)
+        while not done.wait(1):
+            pass
+        return responses[0]
+
+    def serve_lines(self, lines, out):
+        """
+        Answer a query per line of the file lines (as they complete - match them up by id,
+        default the line number).  Each line is answered as soon as it is read.
+        """
+        lock = threading.Lock()
+        finished = threading.Semaphore(0)
+
+        def write(response):
+            with lock:
+                out.write(json.dumps(response) + '\n')
+                out.flush()
+            finished.release()
+
+        submitted = 0
+        # (Not iterating over lines - that reads ahead, so wouldn't answer until EOF.)
+        for number, line in enumerate(iter(lines.readline, ''), 1):
+            query = parse_query(line, number)
+            if query is None:
+                continue
+            submitted += 1
+            if 'error' in query:
+                write(query)
+            else:
+                self.submit(query, write)
+        for i in range(submitted):
+            finished.acquire()
+
+    def serve_socket(self, path):
+        """ Answer queries (a line each) from any number of connections to a Unix socket at path. """
+        server = AnagramSocketServer(path, self)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(path)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def latency_stats(self):
+        """ Number of queries answered and latency percentiles (in milliseconds). """
+        with self.lock:
+            latencies = sorted(self.latencies)
+        stats = {'queries': len(latencies)}
+        for p in (50, 90, 99, 100):
+            stats['p%d_ms' % p] = 1000 * percentile(latencies, p) if latencies else 0.0
+        return stats
+
+    def format_stats(self):
+        return ("{queries:,d} queries - latency p50 {p50_ms:,.1f} ms, p90 {p90_ms:,.1f} ms, "
+                "p99 {p99_ms:,.1f} ms, max {p100_ms:,.1f} ms".format(**self.latency_stats()))
+
+
+class AnagramSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, anagram_server):
+        self.anagram_server = anagram_server
+        socketserver.UnixStreamServer.__init__(self, path, AnagramRequestHandler)
+
+
+class AnagramRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        number = 0
+        for line in self.rfile:
+            number += 1
+            query = parse_query(line.decode('utf-8'), number)
+            if query is None:
+                continue
+            if 'error' not in query:
+                query = self.server.anagram_server.answer(query)
+            self.wfile.write((json.dumps(query) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def parse_query(line, number):
+    """ Query dict from a line (None if blank) - an error response if it isn't valid. """
+    if not line.strip():
+        return None
+    try:
+        query = json.loads(line)
+        if not isinstance(query, dict):
+            raise ValueError("query is not an object")
+    except ValueError as e:
+        return {'id': number, 'error': "Bad query: %s" % e}
+    query.setdefault('id', number)
+    return query
+
+
+def percentile(values, p):
+    """ p-th percentile (nearest rank) of sorted values. """
+    rank = int(-(-len(values) * p // 100))
+    return values[max(rank, 1) - 1]
+
+
+# Pool worker global (see AnagramServer).
+server_index = None
+
+
+def answer_query(query):
+    """ Pool task: the response to query. """
+    try:
+        anagrams = [' '.join(anagram) for anagram in
+                    server_index.iter_anagrams(signature(query['phrase']), query.get('max_words') or 10,
+                                               query.get('limit'), query.get('timeout'))]
+    except Exception as e:
+        return {'id': query.get('id'), 'error': "%s: %s" % (type(e).__name__, e)}
+    return {'id': query.get('id'), 'anagrams': anagrams, 'count': len(anagrams)}
+
+
+def signature_length(sig):
+    """ Number of letters (prime factors) in a signature. """
+    length = 0
+    for prime in PRIMES:
+        while sig % prime == 0:
+            sig //= prime
+            length += 1
+        if sig == 1:
+            break
+    return length
+
+
 class LetterCounts(object):
     def __init__(self, word=None):
         self.counts = [0] * 26
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+  bench_amb.py - Compare the amb runners on the test_amb.py puzzles (and n queens).
+"""
+import os
+import sys
+import time
+import argparse
+
+from amb import Runner, TrailRunner, ContinuationRunner, ConstraintRunner, MonteCarloRunner, AllDifferent, Fail
+from test_amb import eight_queens, eight_queens_cps
+
+
+def queens(amb, n):
+    """ First placement of n queens (deeper than eight_queens, so more to replay). """
+    cols = set()
+    diag1 = set()
+    diag2 = set()
+    placed = []
+    for row in range(n):
+        col = amb(n)
+        if col in cols or row - col in diag1 or row + col in diag2:
+            raise Fail
+        cols.add(col)
+        diag1.add(row - col)
+        diag2.add(row + col)
+        placed.append(col)
+    return placed
+
+
+def queens_cps(amb, n):
+    """ queens for ContinuationRunner - only the rows after a failed choice are re-run. """
+    cols = set()
+    diag1 = set()
+    diag2 = set()
+    placed = []
+
+    def place(row):
+        if row == n:
+            return list(placed)
+        return amb(n, lambda col: place_at(row, col))
+
+    def place_at(row, col):
+        if col in cols or row - col in diag1 or row + col in diag2:
+            raise Fail
+        cols.add(col)
+        diag1.add(row - col)
+        diag2.add(row + col)
+        placed.append(col)
+        try:
+            return place(row + 1)
+        finally:
+            cols.remove(col)
+            diag1.remove(row - col)
+            diag2.remove(row + col)
+            placed.pop()
+
+    return place(0)
+
+
+def named_queens(amb, n):
+    """ n queens for ConstraintRunner - the column of each row is a named choice. """
+    return [amb(n, name=row) for row in range(n)]
+
+
+def queens_constraints(n):
+    rows = range(n)
+    return [AllDifferent(rows),
+            AllDifferent(rows, key=lambda row, col: row + col),
+            AllDifferent(rows, key=lambda row, col: row - col)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the amb runners.")
+    parser.add_argument("--queens", default=14, type=int,
+                        help="Size of the n queens puzzle.")
+    parser.add_argument("--repeat", default=3, type=int,
+                        help="Best of repeat runs for each runner.")
+    parser.add_argument("--workers", type=int, nargs='*',
+                        help="Instead, sample eight_queens with MonteCarloRunner.run_parallel "
+                             "on each number of workers.")
+    parser.add_argument("--solutions", default=10, type=int,
+                        help="Solutions for each MonteCarloRunner run.")
+    args = parser.parse_args()
+
+    if args.workers is not None:
+        bench_monte_carlo(args.workers or [1], args.solutions)
+        return
+
+    n = args.queens
+    puzzles = (('eight_queens', eight_queens, (), [('ContinuationRunner',
+                                                    lambda: ContinuationRunner(eight_queens_cps), ())]),
+               ('queens(%d)' % n, queens, (n,), [('ContinuationRunner',
+                                                   lambda: ContinuationRunner(queens_cps), (n,)),
+                                                  ('ConstraintRunner',
+                                                   lambda: ConstraintRunner(named_queens,
+                                                                            queens_constraints(n)),
+                                                   (n,))]))
+    # (runs counts function runs - or, for ContinuationRunner, choices tried.)
+    print "%-12s %-18s %10s %10s %8s" % ('puzzle', 'runner', 'runs', 'secs', 'speedup')
+    for name, func, func_args, others in puzzles:
+        runners = [(runner.__name__, lambda runner=runner: runner(func), func_args)
+                   for runner in (Runner, TrailRunner)] + others
+        best = {}
+        runs = {}
+        for i in range(args.repeat):
+            for runner_name, make_runner, runner_args in runners:
+                runs[runner_name], secs = time_run(make_runner(), runner_args)
+                best[runner_name] = min(best.get(runner_name, secs), secs)
+        for runner_name, make_runner, runner_args in runners:
+            print "%-12s %-18s %10s %10.3f %7.2fx" % (name, runner_name, "{:,d}".format(runs[runner_name]),
+                                                     best[runner_name], best['Runner'] / best[runner_name])
+
+
+def bench_monte_carlo(worker_counts, solutions):
+    print "%-8s %12s %12s %14s" % ('workers', 'trials', 'secs', 'trials/sec')
+    for workers in worker_counts:
+        runner = MonteCarloRunner(eight_queens)
+        runner.run_parallel(solutions=solutions, workers=workers, seed=1)
+        stats = runner.stats
+        print "%-8d %12s %12.2f %14s" % (workers, "{:,d}".format(stats['trials']), stats['elapsed'],
+                                         "{:,.0f}".format(stats['trials_per_sec']))
+
+
+def time_run(runner, args):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # Drop the "Total time" line
+    try:
+        start = time.time()
+        runner.run(*args)
+        secs = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return runner.progress.get_count(), secs
+
+
+if __name__ == '__main__':
+    main()
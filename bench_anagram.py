@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+  bench_anagram.py - Time multi-word anagram searches (15-25 letter phrases) with and
+  without the sub-result cache - or, with --workers, streamed in this process and across
+  a process pool.
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+from anagram import AnagramIndex, SubresultCache, signature, letter_count, find_anagrams
+
+PHRASES = ('clint eastwood',            # 13
+           'william shakespeare',       # 18
+           'the morse code here',       # 16
+           'dormitory dirty room',      # 18
+           'a decimal point here',      # 17
+           'eleven plus two twelve',    # 19
+           'the public art galleries',  # 21
+           'astronomers moon starer',   # 21
+           'a telephone girl in paris',  # 21
+           'the country side is green',  # 21
+           'one good turn deserves another',  # 26
+           )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the anagram sub-result cache.")
+    parser.add_argument("--words", default=3, type=int,
+                        help="Most words in an anagram.")
+    parser.add_argument("--min-letters", default=15, type=int,
+                        help="Shortest phrase to time.")
+    parser.add_argument("--max-letters", default=25, type=int,
+                        help="Longest phrase to time.")
+    parser.add_argument("--cache-size", default=100000, type=int,
+                        help="Most sub-results to remember.")
+    parser.add_argument("--workers", type=int,
+                        help="Compare streaming searches in this many processes.")
+    args = parser.parse_args()
+
+    index = AnagramIndex.load()
+    if args.workers:
+        compare_workers(index, args)
+        return
+
+    print("%-26s %7s %10s %8s %8s %8s %8s %10s" % ('phrase', 'letters', 'anagrams', 'secs', 'cached',
+                                                   'speedup', 'hits', 'peak KB'))
+    for phrase in PHRASES:
+        letters = letter_count(phrase)
+        if not args.min_letters <= letters <= args.max_letters:
+            continue
+        sig = signature(phrase)
+        candidates = index.candidates(sig)
+        count, secs = time_search(sig, candidates, index.lengths, args.words, None)
+        cache = SubresultCache(args.cache_size)
+        cached_count, cached_secs = time_search(sig, candidates, index.lengths, args.words, cache)
+        assert cached_count == count
+        stats = cache.get_stats()
+        print("%-26s %7d %10s %8.2f %8.2f %7.1fx %7.0f%% %10s" % (phrase, letters, "{:,d}".format(count), secs,
+                                                                  cached_secs, secs / cached_secs,
+                                                                  100 * stats['hit_rate'],
+                                                                  "{:,.0f}".format(stats['peak_kb'])))
+
+
+def compare_workers(index, args):
+    print("%-26s %7s %10s %8s %8s %8s" % ('phrase', 'letters', 'anagrams', 'secs', 'workers', 'speedup'))
+    for phrase in PHRASES:
+        letters = letter_count(phrase)
+        if not args.min_letters <= letters <= args.max_letters:
+            continue
+        sig = signature(phrase)
+        start = time.time()
+        count = sum(1 for anagram in index.iter_anagrams(sig, args.words))
+        secs = time.time() - start
+        start = time.time()
+        parallel_count = sum(1 for anagram in index.iter_anagrams(sig, args.words, workers=args.workers))
+        parallel_secs = time.time() - start
+        assert parallel_count == count
+        print("%-26s %7d %10s %8.2f %8.2f %7.1fx" % (phrase, letters, "{:,d}".format(count), secs, parallel_secs,
+                                                     secs / parallel_secs))
+
+
+def time_search(sig, candidates, lengths, max_words, cache):
+    """ Number of (signature) anagrams of 1 to max_words words, and the seconds taken. """
+    start = time.time()
+    count = 0
+    for use_words in range(1, max_words + 1):
+        count += len(find_anagrams(use_words, sig, candidates, lengths, cache=cache))
+    return count, time.time() - start
+
+
+if __name__ == '__main__':
+    main()
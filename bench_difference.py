@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+  bench_difference.py - Compare search rates (candidates/sec) of the DiffState engines.
+  A candidate is either a step or one skipped by the batch engine.
+"""
+import time
+import argparse
+
+from difference import ENGINES
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DiffState engines.")
+    parser.add_argument("--start", default=10, type=int,
+                        help="Smallest k to benchmark.")
+    parser.add_argument("--end", default=20, type=int,
+                        help="Largest k to benchmark.")
+    parser.add_argument("--seconds", default=2.0, type=float,
+                        help="Time to run each engine for each k.")
+    parser.add_argument("--engines", default=['list', 'bits'], nargs='*', choices=sorted(ENGINES),
+                        help="Engines to compare (the first is the baseline).")
+    args = parser.parse_args()
+
+    print "%4s %5s " % ('k', 'm') + ' '.join("%14s" % engine for engine in args.engines) + \
+        ''.join("  %6s" % ('x ' + engine) for engine in args.engines[1:])
+    for k in range(args.start, args.end + 1):
+        rates = [candidates_per_second(ENGINES[engine], k, args.seconds) for engine in args.engines]
+        print "%4d %5d " % (k, k * (k - 1) + 1) + ' '.join("{:14,.0f}".format(rate) for rate in rates) + \
+            ''.join("  {:6.2f}".format(rate / rates[0]) for rate in rates[1:])
+
+
+def candidates_per_second(engine, k, seconds):
+    """ Run the search for (about) the given number of seconds. """
+    ds = engine(k, start=[0, 1], stop=[1], report_rate=3600)
+    steps = 0
+    start = time.time()
+    deadline = start + seconds
+    while not ds.is_finished():
+        ds.step()
+        ds.next()
+        steps += 1
+        if steps % 1000 == 0 and time.time() >= deadline:
+            break
+    return (steps + getattr(ds, 'skipped', 0)) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+  bench_order.py - Count the steps saved by choice ordering (SearchSpace.choose_ordered):
+  fail-first queens (test_search.py) and OrderedDiffState.
+"""
+import sys
+import time
+import argparse
+
+from test_search import BacktrackQueens, FailFirstQueens
+from difference import DiffState, OrderedDiffState
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark choice ordering heuristics.")
+    parser.add_argument("--queens", default=[4, 6, 8, 10, 12, 14, 16], type=int, nargs='*',
+                        help="Board sizes for the queens searches.")
+    parser.add_argument("--diff", default=[5, 6, 8, 9, 10], type=int, nargs='*',
+                        help="Values of k for the difference set searches.")
+    args = parser.parse_args()
+
+    print "%-22s %12s %12s %10s %10s" % ('search', 'steps', 'ordered', 'ratio', 'speedup')
+    for size in args.queens:
+        compare('queens(%d)' % size, BacktrackQueens(size), FailFirstQueens(size))
+    for k in args.diff:
+        compare('difference(%d)' % k, DiffState(k), OrderedDiffState(k))
+
+
+def compare(name, plain, ordered):
+    steps, secs = time_search(plain)
+    ordered_steps, ordered_secs = time_search(ordered)
+    print "%-22s %12s %12s %9.1fx %9.2fx" % (name, "{:,d}".format(steps), "{:,d}".format(ordered_steps),
+                                              float(steps) / max(ordered_steps, 1),
+                                              secs / ordered_secs)
+
+
+def time_search(searcher):
+    stdout = sys.stdout
+    sys.stdout = sys.stderr  # Keep the "Total time" lines out of the table
+    try:
+        start = time.time()
+        searcher.search()
+        secs = time.time() - start
+    finally:
+        sys.stdout = stdout
+    return searcher.steps_taken(), secs
+
+
+if __name__ == '__main__':
+    main()
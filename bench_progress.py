@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+  bench_progress.py - Measure the per-step overhead of each progress reporting mode.
+"""
+import time
+import argparse
+
+from search import SearchSpace, SearchProgress
+
+
+class Permutations(SearchSpace):
+    """ Enumerate the permutations of range(size) - about as little work per step as possible. """
+    def __init__(self, size=9, **kwargs):
+        super(Permutations, self).__init__(**kwargs)
+        self.size = size
+        self.used = [False] * size
+
+    def step(self):
+        super(Permutations, self).step()
+        choice = self.choose(self.size)
+        if self.used[choice] or self.depth == self.size - 1:
+            return
+        self.used[choice] = True
+        self.accept()
+
+    def backtrack(self, choice):
+        self.used[choice] = False
+
+
+class ProgressPermutations(SearchProgress, Permutations):
+    pass
+
+
+MODES = {'none': lambda size: Permutations(size),
+         'report': lambda size: ProgressPermutations(size=size, report_rate=3600),
+         'sample': lambda size: ProgressPermutations(size=size, report_rate=3600, sample=True),
+         }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark progress reporting overhead.")
+    parser.add_argument("--size", default=8, type=int,
+                        help="Permutations of range(size) to search.")
+    parser.add_argument("--repeat", default=5, type=int,
+                        help="Best of repeat runs for each mode.")
+    args = parser.parse_args()
+
+    modes = ('none', 'report', 'sample')
+    # Take turns, so each mode sees the same machine load.
+    best = {}
+    for i in range(args.repeat):
+        for mode in modes:
+            steps, secs = time_search(MODES[mode](args.size))
+            best[mode] = min(best.get(mode, secs / steps), secs / steps)
+
+    print "%-8s %14s %10s %12s" % ('mode', 'steps/sec', 'ns/step', 'overhead')
+    for mode in modes:
+        print "%-8s %14s %10.1f %11.1f%%" % (mode, "{:,.0f}".format(1 / best[mode]), best[mode] * 1e9,
+                                              100 * (best[mode] - best['none']) / best['none'])
+
+
+def time_search(searcher):
+    start = time.time()
+    searcher.search()
+    return searcher.steps_taken(), time.time() - start
+
+
+if __name__ == '__main__':
+    main()
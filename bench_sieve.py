@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+  bench_sieve.py - Compare sieve.py with the original (set based) difference.sieve.
+"""
+import time
+import argparse
+
+from sieve import primes, prime_powers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark prime sieves.")
+    parser.add_argument("--max-exponent", default=8, type=int,
+                        help="Benchmark n = 10^3 ... 10^max-exponent.")
+    parser.add_argument("--max-set-exponent", default=7, type=int,
+                        help="Largest power of 10 to run the (slow) set sieve on.")
+    args = parser.parse_args()
+
+    print "%12s %12s %10s %10s %8s" % ('n', 'count', 'set secs', 'secs', 'speedup')
+    for exponent in range(3, args.max_exponent + 1):
+        n = 10 ** exponent
+        for prime_power in (False, True):
+            start = time.time()
+            count = sum(1 for p in (prime_powers(n) if prime_power else primes(n)))
+            secs = time.time() - start
+            if exponent <= args.max_set_exponent:
+                start = time.time()
+                expected = set_sieve(n, prime_power)
+                set_secs = time.time() - start
+                if len(expected) != count:
+                    raise ValueError("Count mismatch for n = %d: %d != %d" % (n, count, len(expected)))
+                print "%12s %12s %10.3f %10.3f %7.1fx" % ("{:,d}".format(n) + ('*' if prime_power else ''),
+                                                          "{:,d}".format(count), set_secs, secs,
+                                                          set_secs / secs)
+            else:
+                print "%12s %12s %10s %10.3f" % ("{:,d}".format(n) + ('*' if prime_power else ''),
+                                                 "{:,d}".format(count), '-', secs)
+    print "(* including prime powers)"
+
+
+def set_sieve(n, prime_power=False):
+    """ The original difference.sieve - marking composites in a set. """
+    sqrt = int(n ** 0.5)
+    comp = set()
+    primes = []
+
+    for i in range(2, n + 1):
+        if i in comp:
+            continue
+        primes.append(i)
+        if i > sqrt:
+            continue
+        for j in range(i * i, n + 1, i):
+            comp.add(j)
+
+        if prime_power:
+            power = i * i
+            while power <= n:
+                primes.append(power)
+                power *= i
+
+    primes.sort()
+
+    return primes
+
+
+if __name__ == '__main__':
+    main()
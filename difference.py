@@ -1,12 +1,20 @@
 #!/usr/bin/env python
+import os
+import json
 import math
+import time
+import ctypes
+import signal
 import argparse
+from fractions import gcd
 from itertools import combinations
 
-from search import SearchSpace, SearchProgress
+from search import SearchSpace, SearchProgress, load_checkpoint, write_atomic
+from progress import Progress, make_sink
+import sieve as segmented_sieve
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--start", default=3, type=int,
                         help="Starting point for size (k) of difference set search.")
@@ -14,63 +22,264 @@ def main():
                         help="Ending point for size of difference set search.")
     parser.add_argument("--all", action="store_true",
                         help="Find all difference sets (does not stop a first solution.")
+    parser.add_argument("--engine", default='list', choices=sorted(ENGINES),
+                        help="DiffState implementation to search with (default: list).")
+    parser.add_argument("--canonical", action="store_true",
+                        help="Prune the search to canonical representatives (under translation and "
+                        "multipliers).")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="Periodically save the search state to FILE.")
+    parser.add_argument("--checkpoint-interval", default=60, type=float, metavar="SECS",
+                        help="Seconds between checkpoints (default: 60).")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the search saved in the --checkpoint file.")
+    parser.add_argument("--sample-progress", action="store_true",
+                        help="Report progress from a background thread (less overhead per step).")
+    parser.add_argument("--metrics", metavar="KIND:FILE",
+                        help="Also write progress metrics to FILE - as JSON lines (jsonl:FILE) or "
+                        "in Prometheus text format (prometheus:FILE).")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="Remember results (and prime powers) in FILE - known results are "
+                        "reported without searching again.")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Search again, even for results in the --cache file.")
     parser.add_argument("prefix", default=[0, 1], type=int, nargs='*',
                         help="Search all solutions that have given prefix.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    primes = sieve(args.end + 1, prime_power=True)
+    if args.metrics:
+        try:
+            Progress.default_sink = make_sink(args.metrics)
+        except ValueError as e:
+            parser.error(str(e))
+
+    resume = None
+    if args.resume:
+        if args.checkpoint is None:
+            parser.error("--resume requires a --checkpoint file.")
+        resume = load_checkpoint(args.checkpoint)
+        print "Resuming k = %d from %s" % (resume['state']['k'], args.checkpoint)
+
+    cache = ResultCache(args.cache) if args.cache is not None else None
+    if cache is not None:
+        primes = cache.prime_powers(args.end + 1)
+    else:
+        primes = sieve(args.end + 1, prime_power=True)
     print "Primes: %r" % primes
+    prime_powers = set(primes)
 
     for k in range(args.start, args.end + 1):
+        if resume is not None and k < resume['state']['k']:
+            continue
+
         print "\nDifference set (k = %d, m = %d)" % (k, k * (k -1) + 1)
 
-        if k > 2 and k - 1 not in primes:
+        if k > 2 and k - 1 not in prime_powers:
             print "Theorem: set k = %d does not exist (since %d is not a prime power)." % (k, k - 1)
             continue
 
-        ds = DiffState(k, start=args.prefix, stop=[1])
-        unique_solutions = []
-        while True:
-            ds.search()
-            if ds.is_solved():
-                for soln in unique_solutions:
-                    if ds.is_inverse(soln):
-                        # print "%s same as %r" % (ds, soln)
-                        break
-                else:
-                    print ds
-                    unique_solutions.append(list(ds.current))
-            if not args.all or ds.is_finished():
-                break
+        if cache is not None and not args.refresh:
+            result = cache.get(k, args.prefix, args.canonical)
+            if result is not None and (result['exhausted'] or (result['solutions'] and not args.all)):
+                for solution in result['solutions'] if args.all else result['solutions'][:1]:
+                    print solution
+                print "Cached result ({:s} in {:,d} steps, {:,.2f} secs)".format(
+                    "{:,d} solutions - search complete".format(len(result['solutions']))
+                    if result['exhausted'] else "first solution", result['steps'], result['seconds'])
+                continue
+
+        ds = ENGINES[args.engine](k, start=args.prefix, stop=[1], canonical=args.canonical,
+                                  checkpoint=args.checkpoint,
+                                  checkpoint_interval=args.checkpoint_interval,
+                                  sample=args.sample_progress)
+        if resume is not None and k == resume['state']['k']:
+            ds.restore_checkpoint(resume)
+            resume = None
+            # Checkpoint was saved after this k was completed.
+            if ds.is_finished() or (ds.is_solved() and not args.all):
+                continue
+
+        signal.signal(signal.SIGINT, lambda signum, frame: ds.interrupt())
+        start_time = time.time()
+        try:
+            for solution in ds.iter_solutions(limit=None if args.all else 1):
+                # Without canonical pruning, skip mirror images of earlier solutions.
+                if not args.canonical and any(ds.is_inverse(soln) for soln in ds.solutions):
+                    continue
+                print ds
+                ds.solutions.append(list(solution))
+        except KeyboardInterrupt:
+            if args.checkpoint is not None:
+                print "Interrupted - resume with --resume --checkpoint %s" % args.checkpoint
+            return
+        finally:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        if args.checkpoint is not None:
+            ds.save_checkpoint()
+
+        if cache is not None:
+            cache.put(k, args.prefix, args.canonical, {'solutions': ds.solutions,
+                                                       'exhausted': ds.is_finished(),
+                                                       'steps': ds.progress.get_count(),
+                                                       'seconds': time.time() - start_time,
+                                                       })
+
+
+class ResultCache(object):
+    """
+    Search results - keyed by k, prefix and canonical - and a table of prime powers, kept
+    in a JSON file.  Each result holds the solutions found (all of them if the search was
+    exhausted), and the steps and time taken.
+    """
+    version = 1
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.data = {'version': self.version,
+                     'prime_powers': {'limit': 0, 'values': []},
+                     'results': {},
+                     }
+        if os.path.exists(file_name):
+            with open(file_name) as input:
+                data = json.load(input)
+            if data.get('version') == self.version:
+                self.data = data
+
+    def prime_powers(self, n):
+        """ Return the primes and prime powers <= n (sieving only if n is a new high). """
+        table = self.data['prime_powers']
+        if table['limit'] < n:
+            table['limit'] = n
+            table['values'] = sieve(n, prime_power=True)
+            self.save()
+        return [p for p in table['values'] if p <= n]
+
+    @staticmethod
+    def key(k, prefix, canonical):
+        return "%d:%s%s" % (k, ','.join(str(i) for i in prefix), ':canonical' if canonical else '')
+
+    def get(self, k, prefix, canonical):
+        return self.data['results'].get(self.key(k, prefix, canonical))
+
+    def put(self, k, prefix, canonical, result):
+        """ Record a result - unless it adds nothing to a result already known. """
+        key = self.key(k, prefix, canonical)
+        known = self.data['results'].get(key)
+        if known is not None and (known['exhausted'] or
+                                  len(known['solutions']) >= len(result['solutions'])) and \
+                not result['exhausted']:
+            return
+        self.data['results'][key] = result
+        self.save()
+
+    def save(self):
+        write_atomic(self.file_name, json.dumps(self.data, separators=(',', ':'), sort_keys=True))
 
 
 class DiffState(SearchProgress, SearchSpace):
-    def __init__(self, k, **kwargs):
+    """
+    Search for (k, m = k(k - 1) + 1, 1) cyclic difference sets.
+
+    With canonical=True, only the canonical representative of each equivalence class
+    (under translation and multipliers - including the reflection x -> -x) is searched
+    for: prefixes that cannot complete to the lexicographically smallest member of their
+    class are pruned in step.
+    """
+    def __init__(self, k, canonical=False, **kwargs):
         super(DiffState, self).__init__(**kwargs)
         self.k = k
         self.m = k * (k - 1) + 1
         self.diff_map = [True] + [False] * (self.m / 2)
         self.low = -1
         self.current = []
+        self.solutions = []
+        self.canonical = canonical
+        if canonical:
+            self.units = [gcd(d, self.m) == 1 for d in range(self.m)]
 
     def __str__(self):
         return str(self.current)
 
+    def diff_bits(self):
+        """ Return the used differences (0 to m / 2) as a bit mask. """
+        diff_bits = 0
+        for d in range(len(self.diff_map) - 1, -1, -1):
+            diff_bits = diff_bits << 1 | self.diff_map[d]
+        return diff_bits
+
+    def get_state(self):
+        return {'k': self.k,
+                'current': self.current,
+                'diff_map': self.diff_bits(),
+                'low': self.low,
+                'solutions': self.solutions,
+                }
+
+    def set_state(self, state):
+        self.current = state['current']
+        self.diff_map = [bool(state['diff_map'] >> d & 1) for d in range(len(self.diff_map))]
+        self.low = state['low']
+        self.solutions = state['solutions']
+
     def step(self):
         super(DiffState, self).step()
         min = self.low + 1
         if len(self.current) > 0:
             min += self.current[-1]
-        candidate = self.choose(min=min,
-                                limit=self.m - self.low - \
-                                    (self.low + 1) * (self.k - len(self.current) - 1))
+        candidate = self.choose_candidate(min, self.m - self.low - \
+                                          (self.low + 1) * (self.k - len(self.current) - 1))
         if candidate is None:
             return
         if self.is_feasible(candidate):
+            if self.canonical and not self.is_canonical():
+                self.backtrack(candidate)
+                return
             self.accept()
             if self.is_solved():
                 return self.current
 
+    def choose_candidate(self, min, limit):
+        return self.choose(min=min, limit=limit)
+
+    def is_canonical(self):
+        """
+        Return False if current can only complete to a non-canonical set.
+
+        Each equivalent normalized set is the image of x -> (x - u) / (v - u) for a pair
+        u, v in the set (with v - u a unit mod m), which maps u and v to 0 and 1.  j is in
+        that image iff u + j (v - u) is in the set.  Membership is known for all values up
+        to the last element of current, so the image and current can be compared (as
+        characteristic vectors) until one of them becomes unknown.  If the image is
+        smaller at the first difference, every completion of current is non-canonical.
+        """
+        m = self.m
+        units = self.units
+        current = self.current
+        # Once the set is complete, membership of every value is known.
+        top = current[-1] if len(current) < self.k else m - 1
+        members = set(current)
+        for u in current:
+            for v in current:
+                delta = v - u
+                if delta < 0:
+                    delta += m
+                if not units[delta]:
+                    continue
+                y = u
+                for j in range(top + 1):
+                    image = y in members
+                    if (j in members) != image:
+                        if image:
+                            return False
+                        break
+                    y += delta
+                    if y >= m:
+                        y -= m
+                    if y > top:
+                        break
+        return True
+
     def is_solved(self):
         return len(self.current) == self.k
 
@@ -118,30 +327,267 @@ class DiffState(SearchProgress, SearchSpace):
         return True
 
 
-def sieve(n, prime_power=False):
-    """ Return all primes less than or equal to n. """
-    sqrt = int(n ** 0.5)
-    comp = set()
-    primes = []
+class BitDiffState(DiffState):
+    """
+    DiffState engine that keeps the used differences in an integer bit mask.
 
-    for i in range(2, n + 1):
-        if i in comp:
-            continue
-        primes.append(i);
-        if i > sqrt:
-            continue
-        for j in range(i * i, n + 1, i):
-            comp.add(j)
+    used has bits d and m - d set for every difference produced by current.  For a
+    candidate a, the new differences a - c are the bits of (reflected >> (m - a)), where
+    reflected has bit m - c set for each c in current, and their mirror images m - (a - c)
+    are the bits of (members << (m - a)).  So feasibility is a few big-int operations
+    rather than a Python loop over current.
+    """
+    def __init__(self, k, **kwargs):
+        super(BitDiffState, self).__init__(k, **kwargs)
+        self.reset_bits()
+
+    def reset_bits(self):
+        self.used = 1
+        self.members = 0
+        self.reflected = 0
+        self.added = []
+
+    def is_feasible(self, a):
+        shift = self.m - a
+        diffs = self.reflected >> shift
+        mirrors = self.members << shift
+        # Differences must be unused - and not collide with each other's mirror images.
+        if diffs & mirrors or (diffs | mirrors) & self.used:
+            return False
 
-        if prime_power:
-            power = i * i
-            while power <= n:
-                primes.append(power)
-                power *= i
+        added = diffs | mirrors
+        self.used |= added
+        self.added.append(added)
+        self.members |= 1 << a
+        self.reflected |= 1 << shift
+        self.current.append(a)
+        self.update_low()
+        return True
+
+    def backtrack(self, a):
+        a = self.current.pop()
+        self.used ^= self.added.pop()
+        self.members ^= 1 << a
+        self.reflected ^= 1 << (self.m - a)
+        self.update_low()
 
-    primes.sort()
+    def update_low(self):
+        """ Highest consecutive difference from zero (the trailing one bits of used). """
+        low = (~self.used & (self.used + 1)).bit_length() - 2
+        self.low = low if low < self.m / 2 else self.m / 2
 
-    return primes
+    def diff_bits(self):
+        return self.used & ((2 << (self.m / 2)) - 1)
+
+    def set_state(self, state):
+        super(BitDiffState, self).set_state(state)
+        current = self.current
+        self.current = []
+        self.reset_bits()
+        for a in current:
+            self.is_feasible(a)
+
+
+class BatchDiffState(BitDiffState):
+    """
+    BitDiffState that rules out every candidate with a repeated difference at once.
+
+    A candidate a repeats a difference iff a - c (mod m) is in used for some c in
+    current - so the forbidden candidates are the union of used rotated by each c in
+    current: k big-int operations per node instead of a step per candidate.  step then
+    jumps straight to the next survivor (choices still hold candidate values, so prefixes
+    and ranges are as for DiffState).  The candidates jumped over are counted in skipped.
+    """
+    def reset_bits(self):
+        super(BatchDiffState, self).reset_bits()
+        # Surviving candidates (as a bit mask) for each length of current.
+        self.survivors = []
+        self.skipped = 0
+
+    def choose_candidate(self, min, limit):
+        candidate = self.choose(min=min, limit=limit)
+        if candidate is None:
+            return None
+        if self.depth == self.guard and self.guard_value < limit:
+            # Never jump past the end of the range.
+            limit = self.guard_value
+        rest = self.get_survivors() >> candidate
+        if rest == 0:
+            next_candidate = limit
+        else:
+            next_candidate = candidate + (rest & -rest).bit_length() - 1
+        if next_candidate > candidate:
+            next_candidate = next_candidate if next_candidate < limit else limit
+            self.skipped += next_candidate - candidate
+            self.choices[self.depth] = next_candidate
+            if next_candidate >= limit:
+                return None
+        return next_candidate
+
+    def get_survivors(self):
+        n = len(self.current)
+        survivors = self.survivors
+        del survivors[n + 1:]
+        if len(survivors) <= n or survivors[n] is None:
+            m = self.m
+            full = (1 << m) - 1
+            used = self.used
+            forbidden = 0
+            for c in self.current:
+                forbidden |= (used << c | used >> (m - c)) & full
+            survivors.extend([None] * (n + 1 - len(survivors)))
+            survivors[n] = full & ~forbidden
+        return survivors[n]
+
+    def backtrack(self, a):
+        super(BatchDiffState, self).backtrack(a)
+        del self.survivors[len(self.current) + 1:]
+
+
+class OrderedDiffState(DiffState):
+    """
+    DiffState that only tries the candidates whose differences with current are all
+    unused (see SearchSpace.choose_ordered) - so fewer steps are taken.  Prefixes are
+    ranks among those candidates: start=[0, 0] for the usual 0, 1 prefix.
+    """
+    def choose_candidate(self, min, limit):
+        return self.choose_ordered(a for a in xrange(min, limit) if self.is_available(a))
+
+    def is_available(self, a):
+        """ Would adding a use only new differences (without changing state)? """
+        half = self.m / 2
+        seen = set()
+        for b in self.current:
+            d = a - b
+            if d > half:
+                d = self.m - d
+            if self.diff_map[d] or d in seen:
+                return False
+            seen.add(d)
+        return True
+
+
+class NativeDiffState(DiffState):
+    """
+    DiffState that runs the search loop in the native kernel (difference_lib.c).
+
+    Prefixes, ranges (start/stop), progress, checkpoints and output are handled in
+    Python as usual (so this can be used as a MultiSearch searcher) - only search()
+    runs natively, in chunks of native_trials candidates.  Build the kernel with:
+
+        make libdifference.so
+    """
+    native_trials = 1000000
+
+    def __init__(self, k, canonical=False, **kwargs):
+        if canonical:
+            raise ValueError("The native engine does not support canonical pruning.")
+        super(NativeDiffState, self).__init__(k, **kwargs)
+        self.native = load_native()
+        self.candidate = None
+
+    def search(self):
+        if self.is_finished():
+            self.complete()
+            return None
+
+        if self.candidate is None:
+            # Start from the prefix (the choices we were constructed with).
+            self.current = list(self.choices)
+            self.candidate = -1
+        elif self.is_solved():
+            # Resume after the last solution.
+            self.candidate = self.current.pop() + 1
+
+        s = (ctypes.c_int * self.k)(*self.current)
+        depth = ctypes.c_int(len(self.current))
+        candidate = ctypes.c_int(self.candidate)
+        trials = ctypes.c_long(0)
+        guard_value = getattr(self, 'guard_value', 0)
+        while True:
+            trials.value = 0
+            result = self.native.diff_search(self.k, s, ctypes.byref(depth), ctypes.byref(candidate),
+                                             self.guard, guard_value, self.native_trials,
+                                             ctypes.byref(trials))
+            self.current = s[:depth.value]
+            self.candidate = candidate.value
+            self.progress.report(self.current, count=trials.value)
+            if result != NATIVE_PAUSED:
+                break
+            self.tick()
+
+        if result == NATIVE_ERROR:
+            raise ValueError("Native search does not support k = %d." % self.k)
+        if result == NATIVE_EXHAUSTED:
+            self.depth = -1
+            self.complete()
+            return None
+        self.complete()
+        return self.current
+
+    def get_state(self):
+        state = super(NativeDiffState, self).get_state()
+        state['candidate'] = self.candidate
+        return state
+
+    def set_state(self, state):
+        super(NativeDiffState, self).set_state(state)
+        self.candidate = state.get('candidate')
+
+
+NATIVE_EXHAUSTED = 0
+NATIVE_SOLVED = 1
+NATIVE_PAUSED = 2
+NATIVE_ERROR = -1
+
+_native = None
+
+
+def load_native():
+    """ Load the native search kernel (libdifference.so, next to this file). """
+    global _native
+    if _native is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libdifference.so')
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError:
+            raise OSError("Native kernel not found (%s) - build it with: make libdifference.so" % path)
+        lib.diff_search.restype = ctypes.c_int
+        lib.diff_search.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int),
+                                    ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+                                    ctypes.c_int, ctypes.c_int, ctypes.c_long,
+                                    ctypes.POINTER(ctypes.c_long)]
+        _native = lib
+    return _native
+
+
+ENGINES = {'list': DiffState,
+           'bits': BitDiffState,
+           'batch': BatchDiffState,
+           'native': NativeDiffState,
+           }
+
+
+def canonical_form(s, m):
+    """ Return the smallest of the normalized multiplier images of difference set s. """
+    members = set(s)
+    best = None
+    for u in s:
+        for v in s:
+            delta = (v - u) % m
+            if gcd(delta, m) != 1:
+                continue
+            image = [j for j in range(m) if (u + j * delta) % m in members]
+            if best is None or image < best:
+                best = image
+    return best
+
+
+def sieve(n, prime_power=False):
+    """ Return all primes (and powers of primes if prime_power) less than or equal to n. """
+    if prime_power:
+        return list(segmented_sieve.prime_powers(n))
+    return list(segmented_sieve.primes(n))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+/* ================================================================
+   difference_lib.c - Difference Set search kernel (shared library).
+
+   The push/pop search loop of difference.c, packaged to be called from
+   Python (see NativeDiffState in difference.py) via ctypes:
+
+       make libdifference.so
+
+   The search visits candidates in the same order as DiffState, so a
+   subtree searched natively gives the same solutions as the Python
+   engines.
+
+   Copyright 2013, Mike Koss
+`================================================================== */
+#include <string.h>
+
+typedef enum {false, true} bool;
+typedef unsigned char byte;
+
+#define MAX_SET 120
+#define MAX_DIFFS (MAX_SET * (MAX_SET - 1) + 1)
+
+#define SEARCH_EXHAUSTED 0
+#define SEARCH_SOLVED 1
+#define SEARCH_PAUSED 2
+#define SEARCH_ERROR -1
+
+typedef struct {
+    int k;
+    int v;
+    int current;
+    int low;
+    int *s;
+    byte diffs[MAX_DIFFS / 2 + 1];
+} DIFF_VARS;
+
+int diff_search(int k, int *s, int *depth, int *candidate, int guard, int guard_value,
+                long max_trials, long *trials);
+static bool push(int a, DIFF_VARS *pdv);
+static int pop(DIFF_VARS *pdv);
+
+/*
+  Search for the next difference set of size k.
+
+  On entry s[0 .. *depth) holds the current (partial) set and *candidate the next value
+  to try at position *depth (or -1 to start from the smallest feasible value).  Values in
+  s[0 .. guard) are fixed, and position guard may not reach guard_value (guard < 0 for
+  no restriction).
+
+  Returns SEARCH_SOLVED with the solution in s (*depth == k), SEARCH_EXHAUSTED when the
+  range has been searched, or SEARCH_PAUSED after max_trials candidates (with s, *depth
+  and *candidate set to resume from).  *trials is incremented by the candidates tried.
+*/
+int diff_search(int k, int *s, int *depth, int *candidate, int guard, int guard_value,
+                long max_trials, long *trials) {
+    DIFF_VARS dv;
+    int a = *candidate;
+    long count = 0;
+
+    if (k < 2 || k > MAX_SET || *depth > k) {
+        return SEARCH_ERROR;
+    }
+
+    dv.k = k;
+    dv.v = k * (k - 1) + 1;
+    dv.current = 0;
+    dv.low = 0;
+    dv.s = s;
+    memset(dv.diffs, 0, sizeof(dv.diffs));
+    dv.diffs[0] = true;
+
+    // Rebuild the difference map - an infeasible prefix continues with the next sibling.
+    for (int i = 0; i < *depth; i++) {
+        if (!push(s[i], &dv)) {
+            a = s[i] + 1;
+            break;
+        }
+    }
+
+    if (a < 0) {
+        a = dv.current == 0 ? 0 : s[dv.current - 1] + dv.low + 1;
+    }
+
+    for (;;) {
+        if (dv.current == k) {
+            *depth = dv.current;
+            *candidate = a;
+            *trials += count;
+            return SEARCH_SOLVED;
+        }
+
+        // No elements chosen yet: DiffState's low is -1.
+        int low = dv.current == 0 ? -1 : dv.low;
+        int limit = dv.v - low - (low + 1) * (k - dv.current - 1);
+        if (dv.current == guard && guard_value < limit) {
+            limit = guard_value;
+        }
+
+        if (a >= limit) {
+            if (dv.current == 0 || dv.current <= guard) {
+                *depth = dv.current;
+                *trials += count;
+                return SEARCH_EXHAUSTED;
+            }
+            a = pop(&dv) + 1;
+            continue;
+        }
+
+        if (count == max_trials) {
+            *depth = dv.current;
+            *candidate = a;
+            *trials += count;
+            return SEARCH_PAUSED;
+        }
+
+        count++;
+        if (push(a, &dv)) {
+            a += dv.low + 1;
+        } else {
+            a++;
+        }
+    }
+}
+
+static bool push(int a, DIFF_VARS *pdv) {
+    int d;
+
+    for (int i = 0; i < pdv->current; i++) {
+        d = a - pdv->s[i];
+        if (d < 0) {
+            d += pdv->v;
+        }
+        if (d > pdv->v / 2) {
+            d = pdv->v - d;
+        }
+        if (pdv->diffs[d]) {
+            for (int j = 0; j < i; j++) {
+                d = a - pdv->s[j];
+                if (d < 0) {
+                    d += pdv->v;
+                }
+                if (d > pdv->v / 2) {
+                    d = pdv->v - d;
+                }
+                pdv->diffs[d] = false;
+            }
+            return false;
+        }
+        pdv->diffs[d] = true;
+    }
+    pdv->s[pdv->current++] = a;
+
+    while (pdv->low < pdv->v / 2 && pdv->diffs[pdv->low + 1]) {
+        pdv->low++;
+    }
+
+    return true;
+}
+
+static int pop(DIFF_VARS *pdv) {
+    int a = pdv->s[--pdv->current];
+    for (int i = 0; i < pdv->current; i++) {
+        int d = a - pdv->s[i];
+        if (d < 0) {
+            d += pdv->v;
+        }
+        if (d > pdv->v / 2) {
+            d = pdv->v - d;
+        }
+        pdv->diffs[d] = false;
+        if (d <= pdv->low) {
+            pdv->low = d - 1;
+        }
+    }
+    return a;
+}
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+"""
+  distributed.py - Search across several hosts, by handing out prefixes of the search
+  tree as leases.
+
+  The coordinator splits a search into prefixes (one level below start - as MultiSearch
+  does) and serves them, over a multiprocessing.managers connection, to any number of
+  workers:
+
+      python distributed.py coordinate difference:DiffState --kwargs '{"k": 10}' --start 0 \\
+          --host 0.0.0.0 --port 5000 --state ds.leases
+      python distributed.py work --address coordinator-host:5000 --authkey <key>    # on each host
+
+  A worker renews its lease while it searches, and hands back every solution under the
+  prefix when it is done.  Leases that are not renewed in time (e.g., the worker died)
+  expire and their prefixes are handed out again.  With a state file, the frontier,
+  outstanding prefixes and solutions are saved on every change - so a restarted
+  coordinator carries on where it left off.
+
+  The coordinator unpickles what workers send it, so anyone who can connect with the
+  authkey can run code on it.  It listens on 127.0.0.1 by default (with a fixed authkey,
+  for workers on the same host).  Listening on any other address needs a secret authkey:
+  given with --authkey, or else generated and printed - pass it to the workers.
+"""
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import importlib
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.managers import BaseManager
+
+from search import load_checkpoint, write_atomic
+
+# authkey for coordinators (and workers) on the loopback interface only.
+LOCAL_AUTHKEY = 'search'
+
+
+class LeaseManager(BaseManager):
+    pass
+
+
+# The LeaseBook of the coordinator's manager process (see init_leases).
+lease_book = None
+
+
+def init_leases(searcher, start, lease_time, state_file, max_solutions, kwargs):
+    global lease_book
+    lease_book = LeaseBook(searcher, start, lease_time, state_file, max_solutions, **kwargs)
+
+
+def get_leases():
+    return lease_book
+
+
+LeaseManager.register('leases', callable=get_leases)
+
+
+class LeaseBook(object):
+    """
+    Book-keeping for the leases of one search (shared with the workers through the
+    LeaseManager).  Only used from the coordinator's manager process.
+    """
+    def __init__(self, searcher, start=None, lease_time=60.0, state_file=None, max_solutions=None,
+                 **kwargs):
+        self.kwargs = kwargs
+        self.searcher_spec = '%s:%s' % (searcher.__module__, searcher.__name__)
+        self.child_length = len(start) + 1 if start is not None else 1
+        self.parent = searcher(start=start, **kwargs)
+        self.lease_time = lease_time
+        self.state_file = state_file
+        self.max_solutions = max_solutions
+        self.lock = threading.Lock()
+        self.exhausted = False
+        self.pending = []
+        self.leases = {}
+        self.next_id = 1
+        self.completed = 0
+        self.expired = 0
+        self.solutions = []
+        self.new_solutions = []
+        # Workers that have asked for leases - and those told the search is done.
+        self.workers = set()
+        self.dismissed = set()
+        if state_file is not None and os.path.exists(state_file):
+            self.restore_state(load_checkpoint(state_file))
+
+    def lease(self, worker=None):
+        """
+        Return the next lease ({'id', 'start', 'kwargs', 'lease_time'}), {'wait': seconds}
+        if there is nothing to hand out just now, or None when the search is done.
+        """
+        with self.lock:
+            self.workers.add(worker)
+            if self.is_done():
+                self.dismissed.add(worker)
+                return None
+            if self.pending:
+                prefix = self.pending.pop(0)
+            elif not self.exhausted:
+                prefix = self.parent.advance_to_depth(self.child_length)
+                if prefix is None:
+                    self.exhausted = True
+                    self.save_state()
+                    if not self.leases:
+                        self.dismissed.add(worker)
+                        return None
+                    return {'wait': min(1.0, self.lease_time)}
+            else:
+                # Nothing left but outstanding leases - which may yet expire.
+                return {'wait': min(1.0, self.lease_time)}
+            lease_id = self.next_id
+            self.next_id += 1
+            self.leases[lease_id] = {'start': list(prefix),
+                                     'worker': worker,
+                                     'expires': time.time() + self.lease_time,
+                                     }
+            self.save_state()
+            return {'id': lease_id,
+                    'start': list(prefix),
+                    'kwargs': self.kwargs,
+                    'lease_time': self.lease_time,
+                    }
+
+    def get_searcher(self):
+        """ The searcher class as a <module>:<class> spec (see load_searcher). """
+        return self.searcher_spec
+
+    def renew(self, lease_id):
+        """ Extend a lease - False if it is no longer held (so the work should be abandoned). """
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None or self.is_done():
+                return False
+            lease['expires'] = time.time() + self.lease_time
+            return True
+
+    def complete(self, lease_id, solutions):
+        """ Record the solutions under a leased prefix - False if the lease had expired. """
+        with self.lock:
+            if self.leases.pop(lease_id, None) is None:
+                return False
+            self.completed += 1
+            for solution in solutions:
+                if self.max_solutions is not None and len(self.solutions) >= self.max_solutions:
+                    break
+                self.solutions.append(list(solution))
+                self.new_solutions.append(list(solution))
+            self.save_state()
+            return True
+
+    def expire(self):
+        """ Hand out the prefixes of leases that were not renewed in time again. """
+        with self.lock:
+            now = time.time()
+            expired = [lease_id for lease_id, lease in self.leases.items() if lease['expires'] <= now]
+            for lease_id in sorted(expired):
+                self.pending.append(self.leases.pop(lease_id)['start'])
+                self.expired += 1
+            if expired:
+                self.save_state()
+            return len(expired)
+
+    def take_solutions(self):
+        """ Solutions completed since the last call. """
+        with self.lock:
+            solutions = self.new_solutions
+            self.new_solutions = []
+            return solutions
+
+    def is_done(self):
+        if self.max_solutions is not None and len(self.solutions) >= self.max_solutions:
+            return True
+        return self.exhausted and not self.pending and not self.leases
+
+    def is_finished(self):
+        with self.lock:
+            return self.is_done()
+
+    def all_dismissed(self):
+        """ Have all the workers been told the search is done? """
+        with self.lock:
+            return self.workers <= self.dismissed
+
+    def get_stats(self):
+        with self.lock:
+            return {'completed': self.completed,
+                    'expired': self.expired,
+                    'leased': len(self.leases),
+                    'pending': len(self.pending),
+                    'solutions': len(self.solutions),
+                    'exhausted': self.exhausted,
+                    }
+
+    def get_state(self):
+        # Outstanding leases will not be renewed after a restart - so count them as pending.
+        return {'parent': self.parent.get_checkpoint(),
+                'exhausted': self.exhausted,
+                'pending': self.pending + [self.leases[lease_id]['start'] for lease_id in sorted(self.leases)],
+                'next_id': self.next_id,
+                'completed': self.completed,
+                'expired': self.expired,
+                'solutions': self.solutions,
+                }
+
+    def restore_state(self, state):
+        self.parent.restore_checkpoint(state['parent'])
+        self.exhausted = state['exhausted']
+        self.pending = state['pending']
+        self.next_id = state['next_id']
+        self.completed = state['completed']
+        self.expired = state['expired']
+        self.solutions = state['solutions']
+
+    def save_state(self):
+        if self.state_file is not None:
+            write_atomic(self.state_file, json.dumps(self.get_state(), separators=(',', ':')))
+
+
+class Coordinator(object):
+    """
+    Serve the prefixes of a search as leases (at address - port 0 picks a free port) until
+    every prefix has been searched, or max_solutions have been found.
+
+    The searcher is constructed (in the manager process) with start and kwargs; workers
+    construct it with start=<leased prefix> and the same kwargs, so kwargs must be
+    JSON serializable.
+
+    Run workers as separate programs (see main), rather than forking them from the
+    coordinator's process - they would inherit its manager connections.
+    """
+    def __init__(self, searcher, start=None, address=('127.0.0.1', 0), authkey=LOCAL_AUTHKEY,
+                 lease_time=60.0, state_file=None, max_solutions=None, poll_interval=0.1, **kwargs):
+        self.manager = LeaseManager(address=address, authkey=authkey)
+        self.manager.start(init_leases, (searcher, start, lease_time, state_file, max_solutions, kwargs))
+        self.address = self.manager.address
+        self.leases = self.manager.leases()
+        self.poll_interval = poll_interval
+        self.stats = None
+
+    def iter_solutions(self, timeout=None):
+        """
+        Generate solutions (as tuples) as the workers complete their leases - until the
+        search is done, or timeout seconds have passed.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            self.leases.expire()
+            for solution in self.leases.take_solutions():
+                yield tuple(solution)
+            if self.leases.is_finished():
+                for solution in self.leases.take_solutions():
+                    yield tuple(solution)
+                return
+            if deadline is not None and time.time() >= deadline:
+                return
+            time.sleep(self.poll_interval)
+
+    def stop(self, linger=2.0):
+        """
+        Shut down the manager - once every worker has been told the search is done, or
+        after linger seconds (other workers will see the connection close and quit).
+        """
+        deadline = time.time() + linger
+        while self.leases.is_finished() and not self.leases.all_dismissed() and time.time() < deadline:
+            time.sleep(self.poll_interval)
+        self.stats = self.leases.get_stats()
+        self.leases = None
+        self.manager.shutdown()
+        sys.stderr.write("Leases: {completed:,d} completed, {expired:,d} expired, {leased:,d} outstanding, "
+                         "{pending:,d} pending; {solutions:,d} solutions\n".format(**self.stats))
+
+
+def connect(address, authkey=LOCAL_AUTHKEY, retry=10.0):
+    """ Return the coordinator's LeaseBook proxy (retrying for up to retry seconds) - or None. """
+    deadline = time.time() + retry
+    while True:
+        manager = LeaseManager(address=address, authkey=authkey)
+        try:
+            manager.connect()
+            return manager.leases()
+        except (socket.error, IOError, EOFError):
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.1)
+
+
+def run_worker(address, searcher, authkey=LOCAL_AUTHKEY, name=None, retry=10.0):
+    """
+    Search leased prefixes until the coordinator says the search is done (or cannot be
+    reached for retry seconds).  Returns the number of leases completed.
+    """
+    if name is None:
+        name = '%s:%d' % (socket.gethostname(), os.getpid())
+    completed = 0
+    leases = None
+    while True:
+        if leases is None:
+            leases = connect(address, authkey, retry)
+            if leases is None:
+                return completed
+        try:
+            lease = leases.lease(name)
+            if lease is None:
+                return completed
+            if 'wait' in lease:
+                time.sleep(lease['wait'])
+                continue
+            if search_lease(leases, lease, searcher):
+                completed += 1
+        except (socket.error, IOError, EOFError):
+            # Coordinator went away (or restarted) - the lease will be handed out again.
+            leases = None
+
+
+def search_lease(leases, lease, searcher):
+    """ Search one leased prefix - renewing the lease as we go - and hand in the solutions. """
+    s = searcher(start=lease['start'], **lease['kwargs'])
+    solutions = []
+    while True:
+        solutions.extend(list(solution) for solution in s.iter_solutions(timeout=lease['lease_time'] / 3))
+        if s.is_finished():
+            return leases.complete(lease['id'], solutions)
+        if not leases.renew(lease['id']):
+            return False
+
+
+def load_searcher(spec):
+    """ The searcher class for a <module>:<class> spec. """
+    module_name, sep, class_name = spec.partition(':')
+    if not class_name:
+        raise ValueError("Searcher should be <module>:<class> (not %r)." % spec)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def is_loopback(host):
+    return host == 'localhost' or host.startswith('127.') or host == '::1'
+
+
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed search with prefix leases.")
+    parser.add_argument("--authkey",
+                        help="Shared secret for coordinator and workers (needed beyond "
+                             "127.0.0.1 - the coordinator generates one if not given).")
+    commands = parser.add_subparsers(dest='command')
+
+    coordinate = commands.add_parser('coordinate', help="Hand out leases (and print solutions).")
+    coordinate.add_argument("searcher",
+                            help="Searcher class, as <module>:<class> (e.g., difference:DiffState).")
+    coordinate.add_argument("--kwargs", default='{}', type=json.loads,
+                            help="Searcher keyword arguments (JSON object).")
+    coordinate.add_argument("--start", type=int, nargs='*',
+                            help="Prefix to search under (leases are one choice deeper).")
+    coordinate.add_argument("--host", default='127.0.0.1',
+                            help="Address to listen on ('' or 0.0.0.0 for all - see --authkey).")
+    coordinate.add_argument("--port", default=5000, type=int,
+                            help="Port to listen on.")
+    coordinate.add_argument("--lease-time", default=60.0, type=float, metavar="SECS",
+                            help="Seconds a lease is held without being renewed.")
+    coordinate.add_argument("--state", metavar="FILE",
+                            help="Save lease state to FILE (and resume from it if it exists).")
+    coordinate.add_argument("--max-solutions", type=int,
+                            help="Stop after this many solutions.")
+
+    work = commands.add_parser('work', help="Search leased prefixes.")
+    work.add_argument("--address", default='127.0.0.1:5000',
+                      help="Coordinator <host>:<port>.")
+    work.add_argument("--retry", default=10.0, type=float, metavar="SECS",
+                      help="Keep trying to reach the coordinator for this long.")
+    args = parser.parse_args()
+
+    if args.command == 'work':
+        address = parse_address(args.address)
+        if args.authkey is None:
+            if not is_loopback(address[0]):
+                sys.exit("--authkey (as printed by the coordinator) is needed for %s." % args.address)
+            args.authkey = LOCAL_AUTHKEY
+        try:
+            leases = connect(address, args.authkey, args.retry)
+            if leases is None:
+                sys.exit("Cannot reach the coordinator at %s." % args.address)
+            searcher = load_searcher(leases.get_searcher())
+            completed = run_worker(address, searcher, args.authkey, retry=args.retry)
+        except AuthenticationError:
+            sys.exit("The coordinator at %s rejected the authkey (use the --authkey it printed)." %
+                     args.address)
+        sys.stderr.write("Completed %d leases.\n" % completed)
+        return
+
+    if args.authkey is None:
+        if is_loopback(args.host):
+            args.authkey = LOCAL_AUTHKEY
+        else:
+            args.authkey = os.urandom(16).encode('hex')
+            sys.stderr.write("Workers need --authkey %s\n" % args.authkey)
+    coordinator = Coordinator(load_searcher(args.searcher), start=args.start,
+                              address=(args.host, args.port), authkey=args.authkey,
+                              lease_time=args.lease_time, state_file=args.state,
+                              max_solutions=args.max_solutions, **args.kwargs)
+    try:
+        for solution in coordinator.iter_solutions():
+            print list(solution)
+            sys.stdout.flush()
+    finally:
+        coordinator.stop()
+
+
+if __name__ == '__main__':
+    main()
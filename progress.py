@@ -1,22 +1,47 @@
 #!/usr/bin/env python
+import os
 import sys
 import time
+import json
+import threading
 
 
 class Progress(object):
+    """
+    Report the rate of progress (counts per second) every report_rate seconds.
+
+    Besides the status line written to stderr, each report can be written to a metrics
+    sink (see JsonLinesSink and PrometheusSink).  Unless one is passed in, the sink is
+    Progress.default_sink - or the one given by the PROGRESS_METRICS environment
+    variable (e.g., PROGRESS_METRICS=jsonl:progress.jsonl; see make_sink).
+    """
     units = (('sec', 1),
              ('min', 60),
              ('hr', 60),
              ('day', 24),
              ('wk', 7),
              ('month', 4))
-    def __init__(self, name='Progress', report_rate=5):
+    # Upper bounds (in seconds) of the histogram buckets for intervals between reports.
+    interval_buckets = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 600)
+    default_sink = None
+
+    def __init__(self, name='Progress', report_rate=5, detail=None, metrics=None, sink=None):
         self.name = name
+        # Optional function returning more status (e.g., an ETA) for the report line.
+        self.detail = detail
+        # Optional function returning a dict of more metrics for the sink.
+        self.metrics = metrics
+        if sink is None:
+            sink = Progress.default_sink or make_sink(os.environ.get('PROGRESS_METRICS'))
+        self.sink = sink
         self.increment = 5
         self.report_rate = report_rate
         self.count = 0
         self.total_count = 0
         self.start_time = time.time()
+        self.sampler = None
+        self.interval_counts = [0] * (len(self.interval_buckets) + 1)
+        self.interval_sum = 0.0
         self.reset()
 
     def reset(self):
@@ -27,32 +52,230 @@ class Progress(object):
     def get_count(self):
         return self.total_count + self.count
 
-    def report(self, status=None, final=False):
+    def report(self, status=None, final=False, count=1):
         if not final:
-            self.count += 1
+            self.count += count
             if self.count < self.increment:
                 return
 
+        self.write_report(status, final)
+
+    def start_sampling(self, counter, status=None):
+        """
+        Report from a background thread, every report_rate seconds, instead of from calls
+        to report().  counter() should return the total count so far (and status() the
+        status to show).
+        """
+        self.sampler = ProgressSampler(self, counter, status)
+        self.sampler.start()
+
+    def stop_sampling(self):
+        """ Stop the sampling thread (if any) and bring the count up to date. """
+        if self.sampler is None:
+            return
+        self.sampler.stop()
+        self.count = self.sampler.counter() - self.total_count
+        self.sampler = None
+
+    def write_report(self, status=None, final=False):
         dt = time.time() - self.interval_start
-        rate = float(self.increment) / dt
+        rate = float(self.count) / dt
 
         if not final:
             self.increment = int(self.count * self.report_rate / dt)
 
+        self.reset()
+        if self.sink is not None:
+            self.record_interval(dt)
+            self.sink.write(self.get_metrics(rate, dt, status, final))
+
         for unit in self.units:
             rate /= unit[1]
             if rate >= 1:
                 break
 
-        self.reset()
-
         if self.total_count > 0:
-            sys.stderr.write("{:,d}. {:s}: {:,.2f}/{:s} @ {:s}\n".format(self.total_count,
-                                                                         self.name,
-                                                                         rate,
-                                                                         unit[0],
-                                                                         status if status is not None else ''
-                                                                         ))
+            detail = self.detail() if self.detail is not None else None
+            sys.stderr.write("{:,d}. {:s}: {:,.2f}/{:s} @ {:s}{:s}\n".format(self.total_count,
+                                                                             self.name,
+                                                                             rate,
+                                                                             unit[0],
+                                                                             status if status is not None else '',
+                                                                             ' (%s)' % detail if detail is not None else ''
+                                                                             ))
         if final:
             sys.stdout.write("Total time {:,.2f} secs (count: {:,d})\n".format(time.time() - self.start_time,
                                                                                self.total_count))
+
+    def record_interval(self, seconds):
+        for i, bound in enumerate(self.interval_buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.interval_buckets)
+        self.interval_counts[i] += 1
+        self.interval_sum += seconds
+
+    def get_metrics(self, rate, interval, status=None, final=False):
+        """ The state of progress as a (JSON serializable) dict. """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.interval_buckets + ('+Inf',), self.interval_counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        metrics = {'name': self.name,
+                   'pid': os.getpid(),
+                   'time': time.time(),
+                   'elapsed': time.time() - self.start_time,
+                   'count': self.total_count,
+                   'rate': rate,
+                   'interval': interval,
+                   'status': list(status) if isinstance(status, (list, tuple)) else status,
+                   'final': final,
+                   'intervals': {'buckets': buckets,
+                                 'sum': self.interval_sum,
+                                 'count': cumulative,
+                                 },
+                   }
+        if self.metrics is not None:
+            metrics.update(self.metrics())
+        return metrics
+
+
+def format_duration(seconds):
+    """ Format seconds in the largest Progress.units that leaves a value of at least 1. """
+    value = float(seconds)
+    for i, unit in enumerate(Progress.units):
+        value /= unit[1]
+        if i + 1 == len(Progress.units) or value < Progress.units[i + 1][1]:
+            break
+    return "{:,.1f} {:s}".format(value, unit[0])
+
+
+class ProgressSampler(threading.Thread):
+    """ Background thread reporting a Progress from the counter() function. """
+    def __init__(self, progress, counter, status=None):
+        super(ProgressSampler, self).__init__(name='%s progress' % progress.name)
+        self.daemon = True
+        self.progress = progress
+        self.counter = counter
+        self.status = status
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while not self.stopped.wait(self.progress.report_rate):
+            self.report()
+
+    def report(self, final=False):
+        """ Report the current count - from this thread or (for a final report) another. """
+        with self.lock:
+            self.progress.count = self.counter() - self.progress.total_count
+            self.progress.write_report(self.status() if self.status is not None else None, final)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class JsonLinesSink(object):
+    """ Append each report, as a line of JSON, to a file ({pid} is replaced by the process id). """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def write(self, metrics):
+        with open(self.file_name.format(pid=os.getpid()), 'a') as output:
+            output.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+
+class PrometheusSink(object):
+    """
+    Keep a file ({pid} is replaced by the process id) in the Prometheus text exposition
+    format, holding the latest report from each Progress (by name) - e.g., for the
+    node_exporter textfile collector.  The file is replaced atomically.
+    """
+    prefix = 'progress'
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.latest = {}
+
+    def write(self, metrics):
+        self.latest[(metrics['pid'], metrics['name'])] = metrics
+        pid = os.getpid()
+        reports = [self.latest[key] for key in sorted(self.latest) if key[0] == pid]
+
+        lines = []
+        for name, kind, help, key in (('count', 'counter', "Total count.", 'count'),
+                                      ('rate', 'gauge', "Counts per second in the last interval.",
+                                       'rate'),
+                                      ('elapsed_seconds', 'gauge', "Seconds since start.", 'elapsed'),
+                                      ('fraction_complete', 'gauge', "Estimated fraction done.",
+                                       'fraction'),
+                                      ('eta_seconds', 'gauge', "Estimated seconds remaining.", 'eta'),
+                                      ):
+            values = [(report, report.get(key)) for report in reports]
+            values = [(report, value) for report, value in values if value is not None]
+            if not values:
+                continue
+            lines.append("# HELP %s_%s %s" % (self.prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (self.prefix, name, kind))
+            for report, value in values:
+                lines.append("%s_%s{%s} %r" % (self.prefix, name, labels(report), float(value)))
+
+        lines.append("# HELP %s_report_interval_seconds Seconds between reports." % self.prefix)
+        lines.append("# TYPE %s_report_interval_seconds histogram" % self.prefix)
+        for report in reports:
+            intervals = report['intervals']
+            for bound, count in intervals['buckets']:
+                lines.append('%s_report_interval_seconds_bucket{%s,le="%s"} %d' %
+                             (self.prefix, labels(report), bound, count))
+            lines.append("%s_report_interval_seconds_sum{%s} %r" %
+                         (self.prefix, labels(report), intervals['sum']))
+            lines.append("%s_report_interval_seconds_count{%s} %d" %
+                         (self.prefix, labels(report), intervals['count']))
+
+        lines.append("# HELP %s_status Current status (e.g., search prefix)." % self.prefix)
+        lines.append("# TYPE %s_status gauge" % self.prefix)
+        for report in reports:
+            lines.append('%s_status{%s,status="%s"} 1' %
+                         (self.prefix, labels(report), escape_label(report['status'])))
+
+        file_name = self.file_name.format(pid=pid)
+        temp_name = file_name + '.tmp'
+        with open(temp_name, 'w') as output:
+            output.write('\n'.join(lines) + '\n')
+        os.rename(temp_name, file_name)
+
+
+def labels(report):
+    return 'name="%s",pid="%d"' % (escape_label(report['name']), report['pid'])
+
+
+def escape_label(value):
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+SINKS = {'jsonl': JsonLinesSink,
+         'prometheus': PrometheusSink,
+         }
+
+_sinks = {}
+
+
+def make_sink(spec):
+    """
+    Return the (shared) sink for a spec of the form <kind>:<file name>, where kind is one
+    of SINKS - or None for an empty spec.
+    """
+    if not spec:
+        return None
+    if spec not in _sinks:
+        kind, sep, file_name = spec.partition(':')
+        if kind not in SINKS or not file_name:
+            raise ValueError("Metrics sink should be one of %s followed by :<file name> (not %r)." %
+                             (', '.join(sorted(SINKS)), spec))
+        _sinks[spec] = SINKS[kind](file_name)
+    return _sinks[spec]
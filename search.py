@@ -1,7 +1,13 @@
 import os
-from multiprocessing import cpu_count, Pool
+import sys
+import time
+import json
+import random
+from collections import OrderedDict
+from multiprocessing import cpu_count, Pool, Process, Queue, RawValue, Value
+from Queue import Empty, Queue as ThreadQueue
 
-from progress import Progress
+from progress import Progress, format_duration
 
 
 class SearchSpace(object):
@@ -41,8 +47,29 @@ class SearchSpace(object):
     the backtrack function (if provided) to undo the effect of an earlier choice.  If no backtrack
     function is given, search will call your restart function, and restart the search from the root
     of the search tree (similar to use of the McCarthy's ambiguous function).
+
+    Long searches can be checkpointed: pass checkpoint=<file name> and the search frontier
+    (choices, limits, steps, depth and range guard) is written to the file every
+    checkpoint_interval seconds.  Subclasses with state of their own should implement
+    get_state/set_state so it is saved along with the frontier.  To resume, construct the
+    searcher as before and call restore_checkpoint(load_checkpoint(file name)).
+
+    To try values in an order of your own (e.g., best first), call choose_ordered
+    instead of choose.  Which decision to make at each depth is up to step - e.g., the
+    variable with the smallest remaining domain (fail-first) - as long as it depends only
+    on the choices made so far.
+
+    Searches that reach the same state by different paths can pass transpositions=<max
+    entries> and implement state_key.  The keys of states whose subtrees were searched
+    without finding a solution are kept in a TranspositionTable (the least recently used
+    are dropped when it is full), and accepting a state already known to be dead is
+    undone (as if it had been infeasible).
     """
-    def __init__(self, start=None, stop=None):
+    # Number of steps between calls to tick().
+    tick_steps = 10000
+
+    def __init__(self, start=None, stop=None, checkpoint=None, checkpoint_interval=60,
+                 transpositions=None):
         if start is None:
             start = []
         self.choices = list(start)
@@ -54,8 +81,27 @@ class SearchSpace(object):
             self.guard = len(stop) - 1
             if self.guard >= 0:
                 self.guard_value = stop[self.guard]
+        # First choice (at the guard depth) of the range - for fraction_complete.
+        self.range_start = start[self.guard] if 0 <= self.guard < len(start) else None
         self.steps = []
         self.limits = []
+        self.mins = []
+        # The values tried at each depth, in order, for choose_ordered (None for choose).
+        self.orders = []
+        self.checkpoint_file = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_time = time.time() + checkpoint_interval
+        self.step_count = 0
+        self.countdown = self.countdown_start = self.tick_steps
+        self.interrupted = False
+        self.deadline = None
+        self.cancel = None
+        self.transpositions = TranspositionTable(transpositions) if transpositions else None
+        # State keys of the nodes on the current path (keys[i] is for the state after choices[i]).
+        self.keys = []
+        # Nodes above this depth on the start path are only partly searched (their first
+        # children were start's choices, not min) - so are never recorded as dead.
+        self.partial_depth = max(len(start) - 1, 0)
 
         self.restart()
 
@@ -66,12 +112,122 @@ class SearchSpace(object):
         while not self.is_finished():
             result = self.step()
             if result is not None:
+                # Every state on the path to a solution is alive.
+                self.keys = [None] * len(self.keys)
                 self.complete()
                 return result
             self.next()
+            self.countdown -= 1
+            if self.countdown == 0:
+                self.tick()
 
         self.complete()
 
+    def iter_solutions(self, limit=None, timeout=None):
+        """
+        Generate solutions (as tuples) until the search is finished, limit solutions
+        have been found, or timeout seconds have passed.
+
+        A stopped search can be continued by calling iter_solutions again.
+        """
+        self.deadline = time.time() + timeout if timeout is not None else None
+        count = 0
+        try:
+            while limit is None or count < limit:
+                result = self.search()
+                if result is None:
+                    return
+                count += 1
+                yield tuple(result)
+        except (SearchTimeout, SearchCancelled):
+            pass
+        finally:
+            self.deadline = None
+
+    def tick(self):
+        """ Periodic housekeeping - called every tick_steps steps from search(). """
+        self.reset_countdown(self.tick_steps)
+        if self.checkpoint_file is not None and \
+                (self.interrupted or time.time() >= self.checkpoint_time):
+            self.save_checkpoint()
+        if self.interrupted:
+            raise KeyboardInterrupt
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise SearchTimeout
+        if self.cancel is not None and self.cancel.value:
+            raise SearchCancelled
+
+    def watch_cancel(self, flag, tick_steps=1000):
+        """
+        Stop search() (raising SearchCancelled) soon after the shared flag (e.g., a
+        multiprocessing RawValue) becomes non-zero.
+        """
+        self.cancel = flag
+        self.tick_steps = tick_steps
+        self.reset_countdown(min(self.countdown, tick_steps))
+
+    def interrupt(self):
+        """ Stop search() at the next step boundary (saving a checkpoint first). """
+        self.interrupted = True
+        self.reset_countdown(1)
+
+    def reset_countdown(self, steps):
+        """ Call tick() after another steps steps (keeping count of the steps taken). """
+        self.step_count += self.countdown_start - self.countdown
+        self.countdown = self.countdown_start = steps
+
+    def steps_taken(self):
+        """
+        Number of (non-solution) steps taken by search() - read from the countdown, so
+        cheap enough to poll from another thread.
+        """
+        return self.step_count + self.countdown_start - self.countdown
+
+    def state_key(self):
+        """
+        Override (with transpositions=<max entries>) to return a hashable key for the
+        current state - equal keys must have equal subtrees - or None to not cache it.
+        """
+        return None
+
+    def get_state(self):
+        """ Override to return (JSON serializable) subclass state to be checkpointed. """
+        return None
+
+    def set_state(self, state):
+        """ Override to restore subclass state saved by get_state. """
+        pass
+
+    def get_checkpoint(self):
+        return {'choices': self.choices,
+                'limits': self.limits,
+                'mins': self.mins,
+                'orders': self.orders,
+                'steps': self.steps,
+                'depth': self.depth,
+                'guard': self.guard,
+                'guard_value': getattr(self, 'guard_value', None),
+                'state': self.get_state(),
+                }
+
+    def restore_checkpoint(self, checkpoint):
+        self.choices = checkpoint['choices']
+        self.limits = checkpoint['limits']
+        self.mins = checkpoint.get('mins', [0] * len(self.limits))
+        self.orders = checkpoint.get('orders', [None] * len(self.limits))
+        self.steps = checkpoint['steps']
+        self.depth = checkpoint['depth']
+        self.guard = checkpoint['guard']
+        if checkpoint['guard_value'] is not None:
+            self.guard_value = checkpoint['guard_value']
+        self.accepted = False
+        self.partial_depth = max(len(self.choices) - 1, 0)
+        self.set_state(checkpoint['state'])
+
+    def save_checkpoint(self):
+        write_atomic(self.checkpoint_file, json.dumps(self.get_checkpoint(), separators=(',', ':')))
+        self.checkpoint_time = time.time() + self.checkpoint_interval
+
     def advance_to_depth(self, target_depth):
         """ Advance to next feasible prefix of a given length. """
         if self.is_finished():
@@ -108,14 +264,39 @@ class SearchSpace(object):
         if self.depth == len(self.choices):
             self.choices.append(min)
             self.limits.append(limit)
+            self.mins.append(min)
+            self.orders.append(None)
             self.steps.append(step)
         elif self.depth == len(self.limits):
             self.limits.append(limit)
+            self.mins.append(min)
+            self.orders.append(None)
             self.steps.append(step)
         if min >= limit:
             return None
         return self.choices[self.depth]
 
+    def choose_ordered(self, values, key=None):
+        """
+        Choose from values, in order (or in order of key(value), lowest first), rather
+        than counting from min to limit.  Returns None if there are no values.
+
+        values is only read the first time a depth is reached (so can be a generator
+        expression); the order is kept until the search backtracks above this depth.  The
+        choices stack (and so start/stop prefixes and checkpoints) holds the rank of the
+        value in the order, rather than the value itself.
+        """
+        depth = self.depth
+        if depth < len(self.limits):
+            rank = self.choose(self.limits[depth])
+        else:
+            order = sorted(values, key=key) if key is not None else list(values)
+            rank = self.choose(len(order))
+            self.orders[depth] = order
+        if rank is None:
+            return None
+        return self.orders[depth][rank]
+
     def accept(self):
         self.accepted = True
         self.depth += 1
@@ -123,7 +304,18 @@ class SearchSpace(object):
     def next(self):
         if self.accepted:
             self.accepted = False
-            return
+            if self.transpositions is None:
+                return
+            key = self.state_key()
+            if key is None or key not in self.transpositions:
+                del self.keys[self.depth - 1:]
+                self.keys.extend([None] * (self.depth - 1 - len(self.keys)))
+                self.keys.append(key if self.depth - 1 >= self.partial_depth else None)
+                return
+            # Known dead end - undo the accept.
+            self.depth -= 1
+            if hasattr(self, 'backtrack'):
+                self.backtrack(self.choices[self.depth])
 
         self.advance()
 
@@ -135,79 +327,693 @@ class SearchSpace(object):
                 self.backtrack(self.choices[depth])
             self.choices[depth] += self.steps[depth]
             if self.choices[depth] < self.limits[depth]:
+                self.partial_depth = min(self.partial_depth, depth)
                 break
+            if depth == self.guard:
+                # Range is exhausted - never carry into the fixed prefix above the guard.
+                self.depth = -1
+                return
             depth -= 1
+            if self.transpositions is not None and 0 <= depth < len(self.keys) and \
+                    self.keys[depth] is not None:
+                self.transpositions.add(self.keys[depth])
 
         if depth < provisional:
             self.depth = depth
             del self.choices[depth + 1:]
             del self.steps[depth + 1:]
             del self.limits[depth + 1:]
+            del self.mins[depth + 1:]
+            del self.orders[depth + 1:]
+            del self.keys[depth + 1:]
 
         if not hasattr(self, 'backtrack') and not self.is_finished():
             self.restart()
 
+    def split(self):
+        """
+        Give away the unexplored siblings at the shallowest open depth.
+
+        Returns (start, stop) describing the donated range (suitable for constructing
+        a new searcher), and narrows this search to exclude it.  Returns None
+        if there are no unexplored siblings to give away.
+        """
+        for depth in range(max(self.guard, 0), self.depth):
+            next_choice = self.choices[depth] + self.steps[depth]
+            end = self.limits[depth]
+            if depth == self.guard:
+                end = min(end, self.guard_value)
+            if next_choice >= end:
+                continue
+            start = self.choices[:depth] + [next_choice]
+            if self.guard < 0:
+                stop = []
+            else:
+                stop = self.choices[:self.guard] + [self.guard_value]
+            if depth != self.guard:
+                self.range_start = None
+            self.guard = depth
+            self.guard_value = next_choice
+            return start, stop
+        return None
+
+    def fraction_complete(self):
+        """
+        Estimate the fraction of the search (range) done - assuming that all the subtrees
+        at each depth are the same size.  Returns None if there is nothing to go on
+        (no choices made yet).
+        """
+        if self.is_finished():
+            return 1.0
+        # Copies - as this may be called from a progress sampling thread.
+        choices, limits, mins = list(self.choices), list(self.limits), list(self.mins)
+        levels = min(len(choices), len(limits), len(mins))
+        base = max(self.guard, 0)
+        if levels <= base:
+            return None
+
+        fraction = 0.0
+        for depth in range(levels - 1, base - 1, -1):
+            low = mins[depth]
+            high = limits[depth]
+            if depth == self.guard:
+                if self.range_start is not None:
+                    low = self.range_start
+                high = min(high, self.guard_value)
+            fraction = (choices[depth] - low + fraction) / max(high - low, 1)
+        return min(max(fraction, 0.0), 1.0)
+
     def complete(self):
         pass
 
 
+class TranspositionTable(object):
+    """ Bounded set of dead state keys - dropping the least recently used when full. """
+    # Rough bytes per entry on top of the key itself (OrderedDict slot and links).
+    entry_overhead = 200
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.key_bytes = 0
+
+    def __contains__(self, key):
+        if key in self.entries:
+            self.hits += 1
+            # Move to the most recently used end.
+            del self.entries[key]
+            self.entries[key] = True
+            return True
+        self.misses += 1
+        return False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key):
+        if key in self.entries:
+            return
+        if len(self.entries) >= self.max_entries:
+            old_key, value = self.entries.popitem(last=False)
+            self.key_bytes -= sys.getsizeof(old_key)
+            self.evictions += 1
+        self.entries[key] = True
+        self.key_bytes += sys.getsizeof(key)
+
+    def memory(self):
+        """ Approximate bytes used (by the keys and the table's entries). """
+        return self.key_bytes + len(self.entries) * self.entry_overhead
+
+    def get_stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'evictions': self.evictions,
+                'bytes': self.memory(),
+                }
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchCancelled(Exception):
+    pass
+
+
 class SearchProgress(object):
-    def __init__(self, name='Search', report_rate=5, **kwargs):
+    """
+    Mixin reporting search progress - including the fraction of the search done and
+    an ETA (from the rate at which that fraction is growing).
+
+    With sample=True, step() does no reporting at all: a background thread samples the
+    step count (see SearchSpace.steps_taken) while search() is running instead.
+    """
+    def __init__(self, name='Search', report_rate=5, sample=False, **kwargs):
         super(SearchProgress, self).__init__(**kwargs)
-        self.progress = Progress(name=name, report_rate=report_rate)
+        self.progress = Progress(name=name, report_rate=report_rate, detail=self.progress_detail,
+                                 metrics=self.progress_metrics)
+        self.eta_sample = None
+        self.sample = sample
+
+    def eta(self):
+        """ Estimated seconds until the search is finished (None if not known yet). """
+        fraction = self.fraction_complete()
+        if fraction is None:
+            return None
+        now = time.time()
+        if self.eta_sample is None or fraction < self.eta_sample[1]:
+            self.eta_sample = (now, fraction)
+            return None
+        start_time, start_fraction = self.eta_sample
+        if fraction <= start_fraction:
+            return None
+        return (now - start_time) * (1 - fraction) / (fraction - start_fraction)
+
+    def progress_metrics(self):
+        metrics = {'fraction': self.fraction_complete(), 'eta': self.eta()}
+        if self.transpositions is not None:
+            for key, value in self.transpositions.get_stats().items():
+                metrics['transposition_' + key] = value
+        return metrics
+
+    def progress_detail(self):
+        details = []
+        fraction = self.fraction_complete()
+        if fraction is not None:
+            eta = self.eta()
+            if eta is None:
+                details.append("{:.2%} done".format(fraction))
+            else:
+                details.append("{:.2%} done, ETA {:s}".format(fraction, format_duration(eta)))
+        if self.transpositions is not None:
+            stats = self.transpositions.get_stats()
+            details.append("transpositions: {hits:,d} hits, {misses:,d} misses, "
+                           "{entries:,d} entries ({kb:,.0f} KB)".format(kb=stats['bytes'] / 1024.0,
+                                                                       **stats))
+        return ', '.join(details) if details else None
+
+    def search(self):
+        started = self.start_sampling()
+        try:
+            return super(SearchProgress, self).search()
+        finally:
+            if started:
+                self.progress.stop_sampling()
+
+    def iter_solutions(self, limit=None, timeout=None):
+        # One sampling thread for the whole run (rather than one per solution).
+        started = self.start_sampling()
+        try:
+            for solution in super(SearchProgress, self).iter_solutions(limit, timeout):
+                yield solution
+        finally:
+            if started:
+                self.progress.stop_sampling()
+
+    def start_sampling(self):
+        """ Start sampling progress (if sample and not already) - returns whether it was started. """
+        if not self.sample or self.progress.sampler is not None:
+            return False
+        base = self.steps_taken() - self.progress.get_count()
+        self.progress.start_sampling(lambda: self.steps_taken() - base,
+                                     lambda: list(self.choices))
+        return True
 
     def step(self):
         super(SearchProgress, self).step()
-        self.progress.report(self.choices)
+        if not self.sample:
+            self.progress.report(self.choices)
 
     def complete(self):
         super(SearchProgress, self).complete()
-        self.progress.report(self.choices, final=True)
+        if self.progress.sampler is not None:
+            self.progress.sampler.report(final=True)
+        else:
+            self.progress.report(self.choices, final=True)
+
+    def get_checkpoint(self):
+        checkpoint = super(SearchProgress, self).get_checkpoint()
+        checkpoint['count'] = self.progress.get_count()
+        return checkpoint
+
+    def restore_checkpoint(self, checkpoint):
+        super(SearchProgress, self).restore_checkpoint(checkpoint)
+        self.progress.total_count = checkpoint.get('count', 0)
 
 
 class MultiSearch(object):
-    """ Employ mulitple worker processes to carry out a coordinated search. """
-    def __init__(self, searcher=None, start=None, preorder=False, max_solutions=1, **kwargs):
+    """
+    Employ mulitple worker processes to carry out a coordinated search.
+
+    By default, the search tree is cut at a fixed depth and each prefix is handed to a
+    worker in a process Pool.
+
+    With steal=True, workers instead pull (start, stop) ranges from a shared queue.  When
+    a worker notices that other workers are idle, it splits off the unexplored siblings
+    near the top of its own choices stack (see SearchSpace.split) for them to take.  Every
+    solution found is passed to the callback until max_solutions have been reported
+    (max_solutions=None exhausts the search).  Per-worker utilization is available in
+    worker_stats after join().
+
+    Once max_solutions have been reported, a shared cancel flag tells every worker to
+    abandon its search (it is checked every cancel_steps steps) and no more prefixes
+    are dispatched.
+
+    With adaptive=True, the tree is cut at a depth that varies by region instead (and
+    the start prefix is ignored): subtree sizes are estimated by random probes (see
+    estimate_nodes) and regions are split, or runs of small sibling subtrees batched
+    into (start, stop) ranges, so each task should take between task_time[0] and
+    task_time[1] seconds.
+    """
+    def __init__(self, searcher=None, start=None, preorder=False, max_solutions=1,
+                 steal=False, workers=None, steal_interval=1000, cancel_steps=1000,
+                 adaptive=False, task_time=(0.5, 5.0), probes=10, seed=None, **kwargs):
         self.searcher = searcher
         self.max_solutions = max_solutions
         self.start = start
         self.kwargs = kwargs
         self.child_length = len(start) + 1 if start is not None else 1
         self.parent = self.searcher(**self.kwargs)
-        self.worker_count = cpu_count()
-        self.pool = Pool(self.worker_count)
+        self.worker_count = workers if workers is not None else cpu_count()
+        self.steal = steal
+        self.steal_interval = steal_interval
+        self.adaptive = adaptive
+        self.task_time = task_time
+        self.probes = probes
+        self.rng = random.Random(seed)
+        self.plan_stats = None
+        self.worker_stats = []
         self.searchers = []
+        self.cancel_steps = cancel_steps
+        self.cancelled = RawValue('b', 0)
+        self.completed = 0
+        self.finished_workers = 0
+        if steal:
+            self.pool = None
+            self.tasks = Queue()
+            self.results = Queue()
+            self.idle = Value('i', 0)
+            # The parent holds one pending token until all prefixes are queued.
+            self.pending = Value('i', 1)
+        else:
+            self.pool = Pool(self.worker_count, initializer=init_worker,
+                             initargs=(self.cancelled, cancel_steps))
 
     def search(self, callback):
         self.callback = callback
 
+        if self.steal:
+            self.start_workers()
+
+        self.task_count = 0
+        for start, stop in self.iter_tasks():
+            if self.cancelled.value:
+                break
+            self.task_count += 1
+            if self.steal:
+                queue_task(self.tasks, self.pending, (start, stop))
+                continue
+            self.pool.apply_async(search_wrapper,
+                                  args=(self.searcher, start),
+                                  kwds=dict(self.kwargs, stop=stop),
+                                  callback=self.search_results)
+
+        if self.steal:
+            finish_task(self.tasks, self.pending, self.worker_count)
+
+    def iter_tasks(self):
+        """ Generate the (start, stop) ranges to be searched. """
+        if self.adaptive:
+            for start, stop in self.plan_tasks():
+                yield start, stop
+            return
+
         while True:
             prefix = self.parent.advance_to_depth(self.child_length)
             if prefix is None:
+                return
+            yield prefix, None
+
+    def plan_tasks(self):
+        """
+        Generate (start, stop) ranges, covering the whole tree in search order, that
+        should each take about task_time seconds to search.
+        """
+        start_time = time.time()
+        self.seconds_per_node = self.calibrate()
+        total = self.estimate_seconds([])
+        min_time, max_time = self.task_time
+        # Don't leave workers idle for want of tasks.
+        max_time = max(min_time, min(max_time, total / self.worker_count))
+
+        self.plan_stats = {'tasks': 0, 'min_depth': None, 'max_depth': 0, 'estimate': total}
+        for start, stop, seconds in self.plan_region([], total, max_time):
+            self.plan_stats['tasks'] += 1
+            self.plan_stats['min_depth'] = min(self.plan_stats['min_depth'], len(start)) \
+                if self.plan_stats['min_depth'] is not None else len(start)
+            self.plan_stats['max_depth'] = max(self.plan_stats['max_depth'], len(start))
+            yield start, stop
+
+        self.plan_stats['seconds'] = time.time() - start_time
+        sys.stderr.write("Planned {tasks:,d} tasks (depth {min_depth:d} to {max_depth:d}) for "
+                         "about {estimate:,.1f} secs of search in {seconds:,.2f} secs\n".format(
+                             **self.plan_stats))
+
+    def plan_region(self, prefix, seconds, max_time):
+        """ Generate tasks, (start, stop, seconds), covering the subtree under prefix. """
+        children = self.children(prefix) if seconds > max_time else []
+        if len(children) == 0:
+            yield prefix, None, seconds
+            return
+
+        # Batch runs of small sibling subtrees into single ranges.
+        batch = []
+        batch_seconds = 0.0
+        for child in children:
+            child_seconds = self.estimate_seconds(child)
+            if batch and batch_seconds + child_seconds > max_time:
+                yield batch_task(batch, batch_seconds)
+                batch = []
+                batch_seconds = 0.0
+            if child_seconds > max_time:
+                for task in self.plan_region(child, child_seconds, max_time):
+                    yield task
+                continue
+            batch.append(child)
+            batch_seconds += child_seconds
+            if batch_seconds >= self.task_time[0]:
+                yield batch_task(batch, batch_seconds)
+                batch = []
+                batch_seconds = 0.0
+        if batch:
+            yield batch_task(batch, batch_seconds)
+
+    def children(self, prefix):
+        """ Return all the feasible one-choice extensions of prefix. """
+        s = self.searcher(start=prefix, **self.kwargs)
+        result = []
+        while True:
+            child = s.advance_to_depth(len(prefix) + 1)
+            if child is None:
+                return result
+            result.append(child)
+
+    def estimate_nodes(self, prefix):
+        """
+        Knuth's estimate of the number of nodes in the subtree under prefix: the mean
+        (over self.probes random paths to a leaf) of 1 + d1 + d1 d2 + ..., where d1, d2,
+        ... are the numbers of children seen along the path.
+        """
+        total = 0
+        for i in range(self.probes):
+            estimate = weight = 1
+            path = prefix
+            while True:
+                children = self.children(path)
+                if len(children) == 0:
+                    break
+                weight *= len(children)
+                estimate += weight
+                path = self.rng.choice(children)
+            total += estimate
+        return float(total) / self.probes
+
+    def estimate_seconds(self, prefix):
+        return self.estimate_nodes(prefix) * self.seconds_per_node
+
+    def calibrate(self, seconds=0.2):
+        """ Measure the time to search one node (by searching from the root). """
+        s = self.searcher(**self.kwargs)
+        nodes = 0
+        steps = 0
+        start = time.time()
+        while not s.is_finished():
+            s.step()
+            if s.accepted:
+                nodes += 1
+            s.next()
+            steps += 1
+            if steps % 100 == 0 and time.time() - start >= seconds:
                 break
-            self.pool.apply_async(search_wrapper,
-                                  args=(self.searcher, prefix),
-                                  kwds=self.kwargs,
-                                  callback=self.search_results)
+        return (time.time() - start) / max(nodes, 1)
+
+    def iter_solutions(self, limit=None, timeout=None):
+        """
+        Search, generating solutions (as tuples) from all the workers as they arrive -
+        until the search is exhausted, limit solutions have been generated, or timeout
+        seconds have passed.  The workers are stopped when the generator is done.
+
+        In steal mode, every solution is generated; otherwise the first solution found
+        under each prefix.  The limit replaces max_solutions.
+        """
+        self.max_solutions = limit
+        if self.steal:
+            self.search(callback=None)
+            results = self.steal_results(timeout)
+        else:
+            arrivals = ThreadQueue()
+            self.search(callback=arrivals.put)
+            results = self.pool_results(arrivals, timeout)
+
+        count = 0
+        try:
+            while limit is None or count < limit:
+                result = next(results, None)
+                if result is None:
+                    break
+                count += 1
+                yield tuple(result)
+        finally:
+            self.stop()
+
+    def start_workers(self):
+        self.start_time = time.time()
+        for worker_id in range(self.worker_count):
+            process = Process(target=steal_worker,
+                              args=(worker_id, self.worker_count, self.searcher, self.kwargs,
+                                    self.tasks, self.results, self.idle, self.pending,
+                                    self.cancelled, self.steal_interval))
+            process.daemon = True
+            process.start()
+            self.searchers.append(process)
 
     def search_results(self, result):
         print "search_results(%r)" % result
-        self.max_solutions -= 1
-        self.callback(result)
+        if result is not None and not self.cancelled.value:
+            if self.max_solutions is not None:
+                self.max_solutions -= 1
+                if self.max_solutions <= 0:
+                    self.cancel()
+            if self.callback is not None:
+                self.callback(result)
+        self.completed += 1
+
+    def cancel(self):
+        """ Tell all workers to abandon their searches. """
+        self.cancelled.value = 1
+        if self.steal:
+            # Wake up any idle workers.
+            for i in range(self.worker_count - self.finished_workers):
+                self.tasks.put(None)
 
     def join(self):
         """ Wait until all workers stopped. """
-        if self.max_solutions <= 0:
-            self.pool.terminate()
-        else:
-            self.pool.close()
+        if self.steal:
+            self.collect_results()
+            return
+
+        self.pool.close()
         self.pool.join()
 
+    def collect_results(self):
+        for result in self.steal_results():
+            self.search_results(result)
+        self.stop()
+
+    def stop(self):
+        """ Stop all the workers (abandoning any search in progress). """
+        if not self.cancelled.value:
+            self.cancel()
+        if self.steal:
+            self.stop_workers()
+        else:
+            self.pool.terminate()
+            self.pool.join()
+
+    def pool_results(self, arrivals, timeout=None):
+        """ Generate the (non-empty) results of the pool tasks as they arrive. """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            remaining = time_remaining(deadline)
+            try:
+                yield arrivals.get(timeout=0.1 if remaining is None else min(0.1, remaining))
+            except Empty:
+                if self.completed >= self.task_count:
+                    # All tasks are done - but results may have arrived since the timeout.
+                    while not arrivals.empty():
+                        yield arrivals.get()
+                    return
+                if deadline is not None and time.time() >= deadline:
+                    return
+
+    def steal_results(self, timeout=None):
+        """ Generate solutions from the steal mode workers until they have all finished. """
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.finished_workers < self.worker_count:
+            try:
+                message = self.results.get(timeout=time_remaining(deadline))
+            except Empty:
+                return
+            if message[0] == 'solution':
+                yield message[2]
+            else:
+                self.worker_stats.append(message[2])
+                self.finished_workers += 1
+
+    def stop_workers(self, grace=1.0):
+        # Give the cancelled workers a chance to exit (and report their stats).
+        for result in self.steal_results(timeout=grace):
+            pass
+        # Terminating a worker that holds a queue lock can hang the queues - so only
+        # terminate workers that fail to exit by themselves.
+        for process in self.searchers:
+            process.join(grace)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.tasks.cancel_join_thread()
+
+        self.worker_stats.sort(key=lambda stats: stats['worker'])
+        self.report_utilization()
+
+    def report_utilization(self):
+        elapsed = time.time() - self.start_time
+        for stats in self.worker_stats:
+            stats['utilization'] = stats['busy'] / elapsed if elapsed > 0 else 0.0
+            sys.stderr.write("Worker {:d}: {:,d} tasks, {:,d} splits, {:,d} steps, "
+                             "{:,.2f} secs busy ({:.1%} utilization)\n".format(stats['worker'],
+                                                                              stats['tasks'],
+                                                                              stats['splits'],
+                                                                              stats['steps'],
+                                                                              stats['busy'],
+                                                                              stats['utilization']))
+
+
+def time_remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
+
+
+def load_checkpoint(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def write_atomic(file_name, data):
+    """ Replace file contents so readers (and crashes) never see a partial file. """
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_name, file_name)
+
+
+# Pool worker globals (see init_worker).
+worker_cancel = None
+worker_cancel_steps = None
+
+
+def init_worker(cancel, cancel_steps):
+    global worker_cancel, worker_cancel_steps
+    worker_cancel = cancel
+    worker_cancel_steps = cancel_steps
+
+
+def batch_task(batch, seconds):
+    """ Task (start, stop, seconds) for a run of sibling prefixes. """
+    if len(batch) == 1:
+        return batch[0], None, seconds
+    return batch[0], batch[-1][:-1] + [batch[-1][-1] + 1], seconds
+
 
 def search_wrapper(Searcher, prefix, **kwargs):
     print "search_wrapper(%r)" % kwargs
+    if worker_cancel is not None and worker_cancel.value:
+        return None
     s = Searcher(start=prefix, **kwargs)
-    return s.search()
+    if worker_cancel is not None:
+        s.watch_cancel(worker_cancel, worker_cancel_steps)
+    try:
+        return s.search()
+    except SearchCancelled:
+        return None
+
+
+def queue_task(tasks, pending, task):
+    with pending.get_lock():
+        pending.value += 1
+    tasks.put(task)
+
+
+def finish_task(tasks, pending, worker_count):
+    """ Release a pending task - the last one out tells all the workers to quit. """
+    with pending.get_lock():
+        pending.value -= 1
+        done = pending.value == 0
+    if done:
+        for i in range(worker_count):
+            tasks.put(None)
+
+
+def steal_worker(worker_id, worker_count, Searcher, kwargs, tasks, results, idle, pending,
+                 cancelled, steal_interval):
+    """ Search (start, stop) ranges from the tasks queue - splitting work off for idle workers. """
+    stats = {'worker': worker_id, 'tasks': 0, 'splits': 0, 'steps': 0, 'busy': 0.0, 'idle': 0.0}
+
+    while True:
+        wait_start = time.time()
+        with idle.get_lock():
+            idle.value += 1
+        task = tasks.get()
+        with idle.get_lock():
+            idle.value -= 1
+        busy_start = time.time()
+        stats['idle'] += busy_start - wait_start
+
+        if task is None or cancelled.value:
+            break
+
+        stats['tasks'] += 1
+        s = Searcher(start=task[0], stop=task[1], **kwargs)
+        countdown = steal_interval
+        while not s.is_finished():
+            result = s.step()
+            if result is not None:
+                results.put(('solution', worker_id, list(result)))
+            s.next()
+            countdown -= 1
+            if countdown == 0:
+                countdown = steal_interval
+                stats['steps'] += steal_interval
+                if cancelled.value:
+                    break
+                if idle.value > 0 and tasks.empty():
+                    donated = s.split()
+                    if donated is not None:
+                        queue_task(tasks, pending, donated)
+                        stats['splits'] += 1
+        s.complete()
+        stats['steps'] += steal_interval - countdown
+        stats['busy'] += time.time() - busy_start
+        finish_task(tasks, pending, worker_count)
+
+    results.put(('stats', worker_id, stats))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+  sieve.py - Segmented, wheel-factored Sieve of Eratosthenes.
+
+  Only numbers coprime to 30 (8 of every 30) are stored - one byte each, in segments of
+  segment_size bytes - so primes up to 10^9 are generated in bounded memory.  Multiples of
+  each sieving prime are crossed off with bytearray slice assignments (8 per prime per
+  segment) rather than a Python loop.
+"""
+import heapq
+from array import array
+import argparse
+from itertools import compress
+
+WHEEL = 30
+RESIDUES = (1, 7, 11, 13, 17, 19, 23, 29)
+SPOKES = len(RESIDUES)
+# Position of each residue (mod 30) in a block of SPOKES bytes.
+POSITION = dict((r, i) for i, r in enumerate(RESIDUES))
+SEGMENT_SIZE = 1 << 20
+
+
+def primes(n, segment_size=SEGMENT_SIZE):
+    """ Generate all primes less than or equal to n (in order). """
+    for p in (2, 3, 5):
+        if p <= n:
+            yield p
+    if n < 7:
+        return
+
+    sieving = small_primes(int(n ** 0.5))[3:]
+    # Segments start on multiples of 30 (and hold a whole number of wheel turns).
+    blocks = max(min(segment_size // SPOKES, n // WHEEL + 1), 1)
+    offsets = array('l', (WHEEL * block + r for block in xrange(blocks) for r in RESIDUES))
+    # Index (in a segment starting at 0) of the next multiple of each prime in each spoke.
+    next_index = [[first_multiple(p, r) for r in RESIDUES] for p in sieving]
+
+    for low in xrange(0, n + 1, WHEEL * blocks):
+        size = min(blocks, (n - low) // WHEEL + 1) * SPOKES
+        segment = bytearray('\x01') * size
+        if low == 0:
+            segment[0] = 0  # 1 is not prime
+        for i, p in enumerate(sieving):
+            step = SPOKES * p
+            indices = next_index[i]
+            for j in range(SPOKES):
+                index = indices[j]
+                if index < size:
+                    count = (size - 1 - index) // step + 1
+                    segment[index::step] = bytearray(count)
+                    index += count * step
+                indices[j] = index - size
+
+        for offset in compress(offsets, segment):
+            prime = low + offset
+            if prime > n:
+                return
+            yield prime
+
+
+def first_multiple(p, r):
+    """ Index (in the wheel) of the first multiple of p, from p^2 on, that is r mod 30. """
+    for q in xrange(p, p + WHEEL):
+        if (p * q) % WHEEL == r:
+            m = p * q
+            return m // WHEEL * SPOKES + POSITION[r]
+
+
+def prime_powers(n, segment_size=SEGMENT_SIZE):
+    """ Generate all primes, and powers of primes, less than or equal to n (in order). """
+    powers = []
+    for p in primes(n, segment_size):
+        while powers and powers[0][0] < p:
+            yield next_power(powers, n)
+        yield p
+        if p * p <= n:
+            heapq.heappush(powers, (p * p, p))
+    while powers:
+        yield next_power(powers, n)
+
+
+def next_power(powers, n):
+    power, p = heapq.heappop(powers)
+    if power * p <= n:
+        heapq.heappush(powers, (power * p, p))
+    return power
+
+
+def small_primes(n):
+    """ Return the primes less than or equal to n (for sieving - n should be modest). """
+    if n < 2:
+        return []
+    odd = bytearray('\x01') * (n // 2 + 1)  # odd[i] represents 2i + 1
+    odd[0] = 0
+    for i in xrange(1, int(n ** 0.5) // 2 + 1):
+        if odd[i]:
+            start = 2 * i * (i + 1)
+            odd[start::2 * i + 1] = bytearray(len(xrange(start, len(odd), 2 * i + 1)))
+    return [2] + [2 * i + 1 for i in compress(xrange(len(odd)), odd) if 2 * i + 1 <= n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List primes (or prime powers).")
+    parser.add_argument("n", type=int,
+                        help="Largest number to consider.")
+    parser.add_argument("--powers", action="store_true",
+                        help="Include powers of primes.")
+    parser.add_argument("--count", action="store_true",
+                        help="Just print the number of them.")
+    args = parser.parse_args()
+
+    numbers = prime_powers(args.n) if args.powers else primes(args.n)
+    if args.count:
+        print "{:,d}".format(sum(1 for number in numbers))
+        return
+    for number in numbers:
+        print number
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
+import os
+import json
+import tempfile
 import unittest
 
-from amb import Runner, Fail, MonteCarloRunner
+from amb import Runner, Fail, MonteCarloRunner, TrailRunner, ContinuationRunner, ConstraintRunner, \
+    AllDifferent, SumBetween, Predicate
+from progress import Progress, JsonLinesSink
 
 
 class TestAmb(unittest.TestCase):
@@ -27,6 +32,19 @@ class TestAmb(unittest.TestCase):
         result = ar.run()
         self.assertEqual(result, True)
 
+    def test_monte_carlo_parallel(self):
+        ar = MonteCarloRunner(two_digits)
+        results = ar.run_parallel(args=(17,), solutions=5, workers=2, seed=1, batch=20)
+        self.assertEqual(len(results), 5)
+        for x, y in results:
+            self.assertEqual(x + y, 17)
+        self.assertEqual(ar.stats['solutions'], 5)
+        self.assertGreaterEqual(ar.stats['trials'], 5)
+        # The same seed finds the same solutions, however many workers.
+        self.assertEqual(MonteCarloRunner(two_digits).run_parallel(args=(17,), solutions=5, workers=1,
+                                                                   seed=1, batch=20),
+                         results)
+
     def test_args(self):
         def test(amb, k):
             x = amb()
@@ -49,6 +67,126 @@ class TestAmb(unittest.TestCase):
         result = ar.run()
         self.assertEqual(len(result), 8)
 
+    def test_trail(self):
+        def test(amb, k):
+            x = amb()
+            y = amb(['a', 'b', 'c'])
+            z = amb(k)
+            if not x or y == 'a' or z < 2:
+                raise Fail
+            return x, y, z
+
+        self.assertEqual(TrailRunner(test).run(4), (True, 'b', 2))
+        self.assertEqual(TrailRunner(eight_queens).run(), Runner(eight_queens).run())
+
+    def test_trail_order(self):
+        def test(amb, found):
+            x = amb(3)
+            y = amb(['x', 'y'])
+            z = amb(0 if x == 1 else 2)
+            found.append((x, y, z))
+            raise Fail
+
+        found = []
+        self.assertRaises(Fail, TrailRunner(test).run, found)
+        self.assertEqual(found, [(0, 'x', 0), (0, 'x', 1), (0, 'y', 0), (0, 'y', 1),
+                                 (2, 'x', 0), (2, 'x', 1), (2, 'y', 0), (2, 'y', 1)])
+
+    def test_continuation(self):
+        runs = [0, 0]
+
+        def test(amb, found):
+            runs[0] += 1
+
+            def then_x(x):
+                runs[1] += 1
+                return amb(['x', 'y'], lambda y: amb(0 if x == 1 else 2,
+                                                     lambda z: found.append((x, y, z)) or fail()))
+            return amb(3, then_x)
+
+        def fail():
+            raise Fail
+
+        found = []
+        self.assertRaises(Fail, ContinuationRunner(test).run, found)
+        self.assertEqual(found, [(0, 'x', 0), (0, 'x', 1), (0, 'y', 0), (0, 'y', 1),
+                                 (2, 'x', 0), (2, 'x', 1), (2, 'y', 0), (2, 'y', 1)])
+        # Failures only re-run the code after the last choice point.
+        self.assertEqual(runs, [1, 3])
+        self.assertEqual(ContinuationRunner(eight_queens_cps).run(), Runner(eight_queens).run())
+
+    def test_constraints(self):
+        def queens(amb):
+            return [[row, amb(8, name=row)] for row in range(8)]
+
+        rows = range(8)
+        runner = ConstraintRunner(queens, [AllDifferent(rows),
+                                           AllDifferent(rows, key=lambda row, col: row + col),
+                                           AllDifferent(rows, key=lambda row, col: row - col)])
+        self.assertEqual(runner.run(), Runner(eight_queens).run())
+        self.assertGreater(runner.pruned, 0)
+        self.assertLess(runner.progress.get_count(), 764)
+
+    def test_sum_constraints(self):
+        def digits(amb):
+            x = amb(10, name='x')
+            y = amb(10, name='y')
+            z = amb(10, name='z')
+            return x, y, z
+
+        runner = ConstraintRunner(digits, [SumBetween('xyz', low=20, highest=9),
+                                           AllDifferent('xyz'),
+                                           Predicate('xz', lambda x, z: x > z)])
+        self.assertEqual(runner.run(), (6, 9, 5))
+        self.assertGreater(runner.pruned, 0)
+        self.assertRaises(Fail, ConstraintRunner(digits, [SumBetween('xyz', high=-1)]).run)
+
+    def test_metrics(self):
+        def test(amb):
+            if amb(10) != 7:
+                raise Fail
+            return True
+
+        handle, file_name = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        try:
+            Progress.default_sink = JsonLinesSink(file_name)
+            Runner(test).run()
+            MonteCarloRunner(test).run()
+            with open(file_name) as lines:
+                reports = [json.loads(line) for line in lines]
+        finally:
+            Progress.default_sink = None
+            os.remove(file_name)
+        self.assertEqual([report['name'] for report in reports if report['final']],
+                         ['Runner', 'MonteCarloRunner'])
+
+
+def eight_queens_cps(amb):
+    """ eight_queens for ContinuationRunner. """
+    def place(queens):
+        row = len(queens)
+        if row == 8:
+            return queens
+        return amb(8, lambda col: place(check(queens, [row, col])))
+
+    def check(queens, place):
+        row, col = place
+        for r, c in queens:
+            if c == col or r - c == row - col or r + c == row + col:
+                raise Fail
+        return queens + [place]
+
+    return place([])
+
+
+def two_digits(amb, total):
+    x = amb(10)
+    y = amb(10)
+    if x + y != total:
+        raise Fail
+    return x, y
+
 
 def eight_queens(amb):
     rows = set()
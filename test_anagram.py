@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from io import StringIO
+
+from anagram import AnagramIndex, AnagramServer, LetterCounts, SubresultCache, signature, find_anagrams
+
+WORDS = ['a', 'ail', 'ails', 'ale', 'Alps', 'lap', 'laps', 'lisp', 'pail', 'pails', 'pal', 'pals', 'sail',
+         'sap', 'slap', 'spa']
+
+
+class TestAnagram(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.dict_file = os.path.join(self.temp_dir, 'words.txt')
+        with open(self.dict_file, 'w') as f:
+            f.write('\n'.join(WORDS) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_signature(self):
+        self.assertEqual(signature('slap'), signature("Pals!"))
+        self.assertNotEqual(signature('slap'), signature('slip'))
+        self.assertEqual(signature('laps') % signature('pal'), 0)
+        self.assertNotEqual(signature('lap') % signature('pals'), 0)
+
+    def test_anagrams(self):
+        index = AnagramIndex.build(self.dict_file)
+        for phrase in ('laps', 'pails', 'a pail', 'sap lisp'):
+            for use_words in range(1, 5):
+                self.assertEqual(index.anagrams(signature(phrase), use_words),
+                                 scan_anagrams(use_words, LetterCounts(phrase), WORDS))
+
+    def test_find_anagrams(self):
+        index = AnagramIndex.build(self.dict_file)
+        phrase = signature('a slap')
+        self.assertEqual(find_anagrams(2, phrase, index.candidates(phrase), index.lengths),
+                         [[signature('laps'), signature('a')]])
+
+    def test_iter_anagrams(self):
+        index = AnagramIndex.build(self.dict_file)
+        for phrase in ('laps', 'pails', 'a pail', 'sap lisp'):
+            streamed = list(index.iter_anagrams(signature(phrase), max_words=3))
+            self.assertEqual(sorted(streamed),
+                             sorted(anagram for use_words in range(1, 4)
+                                    for anagram in index.anagrams(signature(phrase), use_words)))
+        self.assertEqual(list(index.iter_anagrams(signature('pals pail'), limit=3)),
+                         list(index.iter_anagrams(signature('pals pail')))[:3])
+        self.assertEqual(list(index.iter_anagrams(signature('sap lisp'), timeout=-1)), [])
+
+    def test_parallel(self):
+        index = AnagramIndex.build(self.dict_file)
+        for phrase in ('laps', 'a pail', 'pals pail', 'sap lisp', 'a q', 'lap x'):
+            self.assertEqual(list(index.iter_anagrams(signature(phrase), workers=2)),
+                             list(index.iter_anagrams(signature(phrase))))
+
+    def test_cache(self):
+        index = AnagramIndex.build(self.dict_file)
+        cache = SubresultCache(max_entries=3)
+        for phrase in ('sap lisp', 'a pail', 'pals pail', 'sap lisp'):
+            for use_words in range(1, 5):
+                self.assertEqual(index.anagrams(signature(phrase), use_words, cache=cache),
+                                 index.anagrams(signature(phrase), use_words))
+        stats = cache.get_stats()
+        self.assertGreater(stats['hits'], 0)
+        self.assertLessEqual(stats['entries'], 3)
+
+    def test_server(self):
+        index = AnagramIndex.build(self.dict_file)
+        server = AnagramServer(index, workers=2, defaults={'max_words': 3})
+        try:
+            out = Output()
+            server.serve_lines(StringIO(u'{"phrase": "pals pail", "id": 10}\n\n{"phrase": "laps", "limit": 2}\n'
+                                        u'[1]\n'), out)
+            self.assertEqual(server.answer({'phrase': 'pails', 'max_words': 1})['anagrams'], ['pails'])
+        finally:
+            server.close()
+        responses = dict((response['id'], response) for response in map(json.loads, out.lines))
+        self.assertEqual(sorted(responses), [3, 4, 10])
+        self.assertEqual(sorted(responses[10]['anagrams']),
+                         sorted(' '.join(anagram) for anagram in index.iter_anagrams(signature('pals pail'), 3)))
+        self.assertEqual(responses[3]['count'], 2)
+        self.assertIn('error', responses[4])
+        self.assertEqual(server.latency_stats()['queries'], 3)
+
+    def test_server_pipe(self):
+        server = AnagramServer(AnagramIndex.build(self.dict_file), workers=1)
+        read_fd, write_fd = os.pipe()
+        queries = os.fdopen(write_fd, 'w')
+        out = Output()
+        thread = threading.Thread(target=server.serve_lines, args=(os.fdopen(read_fd), out))
+        thread.start()
+        try:
+            # Each query is answered while the next is awaited.
+            for i in range(2):
+                queries.write('{"phrase": "laps"}\n')
+                queries.flush()
+                self.assertTrue(out.wait(i + 1, 10))
+        finally:
+            queries.close()
+            thread.join()
+            server.close()
+        self.assertEqual([json.loads(line)['count'] for line in out.lines], [4, 4])
+
+    def test_index_file(self):
+        index_file = os.path.join(self.temp_dir, 'words.index')
+        built = AnagramIndex.load(self.dict_file, index_file)
+        self.assertTrue(os.path.exists(index_file))
+        loaded = AnagramIndex.load(self.dict_file, index_file)
+        self.assertEqual(loaded.groups, built.groups)
+        self.assertEqual(loaded.signatures, built.signatures)
+        # Longest words first.
+        self.assertEqual([loaded.lengths[sig] for sig in loaded.signatures],
+                         sorted((loaded.lengths[sig] for sig in loaded.signatures), reverse=True))
+
+        # A changed dictionary is re-indexed.
+        with open(self.dict_file, 'a') as f:
+            f.write('lips\n')
+        reloaded = AnagramIndex.load(self.dict_file, index_file)
+        self.assertIn('lips', reloaded.words)
+        with open(index_file) as f:
+            self.assertIn('lips', json.load(f)['words'])
+
+
+class Output(object):
+    def __init__(self):
+        self.lines = []
+        self.written = threading.Condition()
+
+    def write(self, text):
+        with self.written:
+            self.lines.append(text)
+            self.written.notify_all()
+
+    def wait(self, count, timeout):
+        """ Wait (up to timeout seconds) for count lines - returns whether they were written. """
+        deadline = time.time() + timeout
+        with self.written:
+            while len(self.lines) < count and time.time() < deadline:
+                self.written.wait(deadline - time.time())
+            return len(self.lines) >= count
+
+    def flush(self):
+        pass
+
+
+def scan_anagrams(use_words, counts, words, start=0):
+    """ Anagrams by scanning all the words at each level (for comparison). """
+    anagrams = []
+    if use_words <= 0:
+        return anagrams
+    for i in range(start, len(words)):
+        if not counts.contains(words[i]):
+            continue
+        sub_counts = counts.clone()
+        sub_counts.subtract_word(words[i])
+        if sub_counts.is_zero():
+            if use_words == 1:
+                anagrams.append([words[i]])
+            continue
+        for sub_anagram in scan_anagrams(use_words - 1, sub_counts, words, i):
+            anagrams.append([words[i]] + sub_anagram)
+    return anagrams
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,20 @@
 #!/usr/bin/env python
+import os
+import sys
+import shutil
+import tempfile
 import unittest
+from StringIO import StringIO
 
-from difference import DiffState, sieve
+from difference import (DiffState, BitDiffState, BatchDiffState, NativeDiffState, OrderedDiffState,
+                        ResultCache, canonical_form, load_native, main, sieve)
+from search import MultiSearch, load_checkpoint
+
+try:
+    load_native()
+    has_native = True
+except OSError:
+    has_native = False
 
 
 class TestSieve(unittest.TestCase):
@@ -31,6 +44,173 @@ class DifferenceSet(unittest.TestCase):
             ds.search()
             self.assertEqual(ds.current, s)
 
+    def test_bit_engine(self):
+        for s in self.dsets:
+            ds = BitDiffState(len(s))
+            ds.search()
+            self.assertEqual(ds.current, s)
+
+    def test_batch_engine(self):
+        for s in self.dsets:
+            bits = BitDiffState(len(s))
+            bits.search()
+            ds = BatchDiffState(len(s))
+            ds.search()
+            self.assertEqual(ds.current, s)
+            self.assertLessEqual(ds.steps_taken(), bits.steps_taken())
+        self.assertGreater(ds.skipped, 0)
+        # Jumps stop at the end of a range.
+        for start, stop in (([0, 1, 4, 14, 15], [0, 1, 4, 14, 16]), ([0, 1, 4], [0, 1, 5])):
+            self.assertEqual(list(BatchDiffState(5, start=start, stop=stop).iter_solutions()),
+                             list(DiffState(5, start=start, stop=stop).iter_solutions()))
+
+    def test_ordered_engine(self):
+        steps = [0, 0]
+        for s in self.dsets[:6]:
+            ds = DiffState(len(s))
+            ds.search()
+            ordered = OrderedDiffState(len(s))
+            ordered.search()
+            self.assertEqual(ordered.current, s)
+            self.assertLessEqual(ordered.steps_taken(), ds.steps_taken())
+            steps[0] += ds.steps_taken()
+            steps[1] += ordered.steps_taken()
+        self.assertLess(steps[1], steps[0])
+        # Prefixes are ranks among the available candidates.
+        self.assertEqual(list(OrderedDiffState(6, start=[0, 0], stop=[1]).iter_solutions()),
+                         list(DiffState(6, start=[0, 1], stop=[1]).iter_solutions()))
+
+    def test_bit_engine_all(self):
+        for k in (5, 6):
+            solutions = []
+            for engine in (DiffState, BitDiffState, BatchDiffState):
+                ds = engine(k, start=[0, 1], stop=[1])
+                found = []
+                while True:
+                    ds.search()
+                    if ds.is_finished():
+                        break
+                    found.append(list(ds.current))
+                solutions.append(found)
+            self.assertEqual(solutions[0], solutions[1])
+            self.assertEqual(solutions[0], solutions[2])
+            self.assertTrue(len(solutions[0]) > 1)
+
+    @unittest.skipUnless(has_native, "Native kernel not built (make libdifference.so).")
+    def test_native(self):
+        for s in self.dsets:
+            ds = NativeDiffState(len(s))
+            ds.native_trials = 101
+            self.assertEqual(ds.search(), s)
+
+    @unittest.skipUnless(has_native, "Native kernel not built (make libdifference.so).")
+    def test_native_all(self):
+        for k in (5, 6):
+            solutions = []
+            for engine in (DiffState, NativeDiffState):
+                ds = engine(k, start=[0, 1], stop=[1])
+                found = []
+                while True:
+                    ds.search()
+                    if ds.is_finished():
+                        break
+                    found.append(list(ds.current))
+                solutions.append(found)
+            self.assertEqual(solutions[0], solutions[1])
+
+    @unittest.skipUnless(has_native, "Native kernel not built (make libdifference.so).")
+    def test_native_multi(self):
+        solutions = []
+        ms = MultiSearch(searcher=NativeDiffState, start=[0], k=8)
+        ms.search(callback=solutions.append)
+        ms.join()
+        self.assertIn(self.dsets[4], solutions)
+
+    def test_canonical(self):
+        for s in self.dsets[:5]:
+            k = len(s)
+            m = k * (k - 1) + 1
+            for engine in (DiffState, BitDiffState, BatchDiffState):
+                ds = engine(k, start=[0, 1], stop=[1], canonical=True)
+                found = []
+                while True:
+                    ds.search()
+                    if ds.is_finished():
+                        break
+                    found.append(list(ds.current))
+                self.assertEqual(found, [s])
+            mirror = sorted((1 - x) % m for x in s)
+            self.assertEqual(canonical_form(mirror, m), s)
+
+    def test_checkpoint(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(temp_dir, 'ds.checkpoint')
+            ds = DiffState(9, checkpoint=file_name)
+            for i in range(5000):
+                ds.step()
+                ds.next()
+            ds.save_checkpoint()
+            count = ds.progress.get_count()
+
+            resumed = DiffState(9)
+            resumed.restore_checkpoint(load_checkpoint(file_name))
+            self.assertEqual(resumed.progress.get_count(), count)
+            self.assertEqual(resumed.diff_map, ds.diff_map)
+            resumed.search()
+            ds.search()
+            self.assertEqual(resumed.current, ds.current)
+            self.assertEqual(resumed.progress.get_count(), ds.progress.get_count())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_interrupt(self):
+        ds = DiffState(9)
+        ds.interrupt()
+        self.assertRaises(KeyboardInterrupt, ds.search)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.temp_dir, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_main(self, *argv):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            main(list(argv) + ['--cache', self.file_name])
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_prime_powers(self):
+        cache = ResultCache(self.file_name)
+        self.assertEqual(cache.prime_powers(30), sieve(30, prime_power=True))
+        self.assertEqual(ResultCache(self.file_name).prime_powers(10), sieve(10, prime_power=True))
+
+    def test_cli(self):
+        searched = self.run_main('--start', '3', '--end', '6')
+        cached = self.run_main('--start', '3', '--end', '6')
+        self.assertIn('Total time', searched)
+        self.assertNotIn('Total time', cached)
+        self.assertEqual([line for line in cached.splitlines() if not line.startswith('Cached')],
+                         [line for line in searched.splitlines() if not line.startswith('Total')])
+
+        # First solutions do not answer --all - but the complete search then answers both.
+        self.assertIn('Total time', self.run_main('--start', '5', '--end', '5', '--all'))
+        cached = self.run_main('--start', '5', '--end', '5', '--all')
+        self.assertNotIn('Total time', cached)
+        self.assertIn('9 solutions - search complete', cached)
+        self.assertNotIn('Total time', self.run_main('--start', '5', '--end', '5'))
+
+        # Different prefixes are different searches.
+        self.assertIn('Total time', self.run_main('--start', '5', '--end', '5', '0', '2'))
+        self.assertIn('Total time', self.run_main('--start', '5', '--end', '5', '--refresh'))
+
 
 if __name__ == '__main__':
     unittest.main()
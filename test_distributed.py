@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from distributed import Coordinator, connect, search_lease
+from difference import DiffState
+from search import load_checkpoint
+
+
+def start_worker(address):
+    """ Run a worker program (as on another host) against the coordinator at address. """
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.Popen([sys.executable, 'distributed.py', 'work', '--retry', '1',
+                                 '--address', '%s:%d' % address],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=devnull, stderr=devnull)
+
+
+def all_solutions(k):
+    return sorted(DiffState(k, start=[0]).iter_solutions())
+
+
+class TestDistributed(unittest.TestCase):
+    def test_workers(self):
+        coordinator = Coordinator(DiffState, start=[0], k=6)
+        workers = [start_worker(coordinator.address) for i in range(3)]
+        try:
+            solutions = list(coordinator.iter_solutions(timeout=60))
+        finally:
+            coordinator.stop()
+            for worker in workers:
+                worker.wait()
+        self.assertEqual(sorted(solutions), all_solutions(6))
+        self.assertEqual(coordinator.stats['expired'], 0)
+        self.assertEqual([worker.returncode for worker in workers], [0, 0, 0])
+
+    def test_max_solutions(self):
+        coordinator = Coordinator(DiffState, start=[0], max_solutions=5, k=6)
+        worker = start_worker(coordinator.address)
+        try:
+            solutions = list(coordinator.iter_solutions(timeout=60))
+        finally:
+            coordinator.stop()
+            worker.wait()
+        self.assertEqual(len(solutions), 5)
+
+    def test_expired_lease(self):
+        coordinator = Coordinator(DiffState, start=[0], lease_time=0.5, k=6)
+        # A worker that takes a lease and dies.
+        leases = connect(coordinator.address)
+        lost = leases.lease('lost')
+        del leases
+        worker = start_worker(coordinator.address)
+        try:
+            solutions = list(coordinator.iter_solutions(timeout=60))
+        finally:
+            coordinator.stop()
+            worker.wait()
+        self.assertEqual(lost['start'], [0, 1])
+        self.assertEqual(sorted(solutions), all_solutions(6))
+        self.assertGreaterEqual(coordinator.stats['expired'], 1)
+
+    def test_restart(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            state_file = os.path.join(temp_dir, 'ds.leases')
+            coordinator = Coordinator(DiffState, start=[0], state_file=state_file, k=6)
+            leases = connect(coordinator.address)
+            first = leases.lease('a')
+            second = leases.lease('b')
+            self.assertTrue(search_lease(leases, first, DiffState))
+            del leases
+            # Coordinator dies with the second lease outstanding.
+            coordinator.stop(linger=0)
+            # Solutions already handed in are in the state file.
+            solutions = [tuple(solution) for solution in load_checkpoint(state_file)['solutions']]
+
+            coordinator = Coordinator(DiffState, start=[0], state_file=state_file, k=6)
+            stats = connect(coordinator.address).get_stats()
+            self.assertEqual(stats['completed'], 1)
+            self.assertEqual(stats['pending'], 1)
+            worker = start_worker(coordinator.address)
+            try:
+                solutions.extend(coordinator.iter_solutions(timeout=60))
+            finally:
+                coordinator.stop()
+                worker.wait()
+            self.assertEqual(second['start'], [0, 2])
+            self.assertEqual(sorted(solutions), all_solutions(6))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from multiprocessing import RawValue
 import unittest
 
-from search import SearchProgress, SearchSpace, MultiSearch
+from search import SearchProgress, SearchSpace, SearchCancelled, MultiSearch
+from progress import Progress, JsonLinesSink, PrometheusSink, make_sink
 
 
 class TestSearch(unittest.TestCase):
@@ -33,6 +41,61 @@ class TestSearch(unittest.TestCase):
             q = BacktrackQueens(test[0])
             self.assertEqual(q.search(), test[1])
 
+    def test_fail_first_queens(self):
+        for size, expected in self.tests:
+            q = FailFirstQueens(size)
+            result = q.search()
+            self.assertEqual(result is None, expected is None)
+            if result is not None:
+                self.assertEqual(len(result), size)
+                self.assertTrue(FailFirstQueens(size).check_all(result))
+            if size <= 10:
+                plain = BacktrackQueens(size)
+                plain.search()
+                self.assertLessEqual(q.steps_taken(), plain.steps_taken())
+
+    def test_choose_ordered(self):
+        class Words(SearchSpace):
+            def step(self):
+                letter = self.choose_ordered('cab' if self.depth < 2 else '', key=lambda c: -ord(c))
+                if letter is None:
+                    return
+                self.accept()
+                if self.depth == 2:
+                    return [self.orders[0][self.choices[0]], letter]
+
+        self.assertEqual(list(Words().iter_solutions(limit=3)), [('c', 'c'), ('c', 'b'), ('c', 'a')])
+        # Prefixes are ranks in the order.
+        self.assertEqual(list(Words(start=[1, 1]).iter_solutions()), [('b', 'b')])
+        self.assertEqual(list(Words(start=[1], stop=[2]).iter_solutions()),
+                         [('b', 'c'), ('b', 'b'), ('b', 'a')])
+
+    def test_transpositions(self):
+        for target in (60, 61):
+            plain = SubsetSum(range(2, 22, 2), 4, target)
+            cached = SubsetSum(range(2, 22, 2), 4, target, transpositions=1000)
+            self.assertEqual(cached.search(), plain.search())
+            self.assertLess(cached.steps_taken(), plain.steps_taken())
+            self.assertGreater(cached.transpositions.hits, 0)
+        stats = cached.transpositions.get_stats()
+        self.assertEqual(stats['entries'], len(cached.transpositions))
+        self.assertGreater(stats['bytes'], 0)
+        self.assertIn('transpositions: ', cached.progress_detail())
+        self.assertEqual(cached.progress_metrics()['transposition_hits'], stats['hits'])
+
+        # A small table still finds every solution (just with fewer hits).
+        small = SubsetSum(range(1, 11), 3, 12, transpositions=5)
+        self.assertEqual(sorted(set(tuple(sorted(s)) for s in small.iter_solutions())),
+                         sorted(set(tuple(sorted(s)) for s in SubsetSum(range(1, 11), 3, 12).iter_solutions())))
+        self.assertLessEqual(len(small.transpositions), 5)
+        self.assertGreater(small.transpositions.evictions, 0)
+
+        # Nodes on the start path of a range are only partly searched - never dead.
+        for start, stop in (([0, 1, 2, 5], [1]), ([0, 2], [0, 3]), ([1, 0, 3], None)):
+            self.assertEqual(list(SubsetSum(range(1, 11), 4, 10, start=start, stop=stop,
+                                            transpositions=1000).iter_solutions()),
+                             list(SubsetSum(range(1, 11), 4, 10, start=start, stop=stop).iter_solutions()))
+
     def test_all(self):
         q = BacktrackQueens(6)
         count = 0
@@ -43,6 +106,22 @@ class TestSearch(unittest.TestCase):
             count += 1
         self.assertEqual(count, 4)
 
+    def test_iter_solutions(self):
+        solutions = list(BacktrackQueens(6).iter_solutions())
+        self.assertEqual(len(solutions), 4)
+        self.assertEqual(solutions[0], ((0, 1), (1, 3), (2, 5), (3, 0), (4, 2), (5, 4)))
+
+        q = BacktrackQueens(8)
+        self.assertEqual(len(list(q.iter_solutions(limit=3))), 3)
+        self.assertEqual(len(list(q.iter_solutions())), 89)
+
+    def test_iter_timeout(self):
+        q = BacktrackQueens(30)
+        start = time.time()
+        self.assertEqual(list(q.iter_solutions(timeout=0.2)), [])
+        self.assertLess(time.time() - start, 2.0)
+        self.assertIsNone(q.deadline)
+
     def test_start(self):
         q = BacktrackQueens(20, start=[0, 2, 4, 1, 3, 12, 14])
         self.assertEqual(q.search(), self.tests[10][1])
@@ -60,6 +139,29 @@ class TestSearch(unittest.TestCase):
             self.assertEqual(q.advance_to_depth(5), [0, 2, 4, 1, i])
         self.assertEqual(q.advance_to_depth(5), [0, 2, 4, 6, 1])
 
+    def test_prefix_bounds(self):
+        q = BacktrackQueens(8, start=[0, 7])
+        count = 0
+        while q.search() is not None:
+            count += 1
+        self.assertEqual(count, 0)
+        self.assertEqual(q.choices[:1], [0])
+
+    def test_split(self):
+        q = BacktrackQueens(8)
+        solutions = [q.search()]
+        start, stop = q.split()
+        self.assertEqual((start, stop), ([1], []))
+        q2 = BacktrackQueens(8, start=start, stop=stop)
+        for s in (q, q2):
+            while True:
+                result = s.search()
+                if result is None:
+                    break
+                solutions.append(list(result))
+        self.assertEqual(len(solutions), 92)
+        self.assertEqual(len(set(tuple(s) for s in solutions)), 92)
+
     def test_advance_one(self):
         q = BacktrackQueens(5)
         for i in range(5):
@@ -67,6 +169,99 @@ class TestSearch(unittest.TestCase):
         self.assertIsNone(q.advance_to_depth(1), None)
 
 
+    def test_fraction_complete(self):
+        q = BacktrackQueens(6)
+        self.assertIsNone(q.fraction_complete())
+        fractions = []
+        while not q.is_finished():
+            q.step()
+            q.next()
+            fractions.append(q.fraction_complete())
+        self.assertEqual(fractions, sorted(fractions))
+        self.assertEqual(fractions[-1], 1.0)
+
+        q = BacktrackQueens(8, start=[2], stop=[6])
+        for solution in q.iter_solutions():
+            if solution[0][1] == 4:
+                break
+        self.assertTrue(0.5 <= q.fraction_complete() < 0.75)
+        self.assertIn('% done', q.progress_detail())
+
+    def test_eta(self):
+        q = BacktrackQueens(8)
+        q.step()
+        q.next()
+        self.assertIsNone(q.eta())
+        time.sleep(0.01)
+        for i in range(1000):
+            q.step()
+            q.next()
+        eta = q.eta()
+        self.assertGreater(eta, 0)
+        self.assertIn('ETA', q.progress_detail())
+
+    def test_sample_progress(self):
+        q = BacktrackQueens(8)
+        self.assertEqual(len(list(q.iter_solutions())), 92)
+        sampled = BacktrackQueens(8, sample=True, report_rate=0.01)
+        self.assertEqual(len(list(sampled.iter_solutions())), 92)
+        self.assertIsNone(sampled.progress.sampler)
+        # Steps that return a solution are not counted by steps_taken.
+        self.assertEqual(sampled.progress.get_count(), sampled.steps_taken())
+        self.assertEqual(sampled.progress.get_count() + 92, q.progress.get_count())
+
+        # The sampling thread stops however the search ends.
+        sampled = BacktrackQueens(30, sample=True, report_rate=0.01)
+        self.assertEqual(list(sampled.iter_solutions(timeout=0.2)), [])
+        self.assertIsNone(sampled.progress.sampler)
+        sampled.watch_cancel(RawValue('b', 1), 1)
+        self.assertRaises(SearchCancelled, sampled.search)
+        self.assertIsNone(sampled.progress.sampler)
+        self.assertEqual(threading.active_count(), 1)
+
+    def test_metrics(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            jsonl = os.path.join(temp_dir, 'progress.jsonl')
+            Progress.default_sink = JsonLinesSink(jsonl)
+            q = BacktrackQueens(6, report_rate=0)
+            q.search()
+            with open(jsonl) as lines:
+                reports = [json.loads(line) for line in lines]
+            self.assertTrue(reports[-1]['final'])
+            self.assertEqual(reports[-1]['count'], q.progress.get_count())
+            self.assertEqual(reports[-1]['status'], [1, 3, 5, 0, 2, 4])
+            self.assertEqual(reports[-1]['intervals']['count'], len(reports))
+            self.assertEqual(reports[-1]['intervals']['buckets'][-1], ['+Inf', len(reports)])
+            self.assertIn('eta', reports[-1])
+
+            prom = os.path.join(temp_dir, 'progress-{pid}.prom')
+            Progress.default_sink = PrometheusSink(prom)
+            q = BacktrackQueens(6, name='Queens', report_rate=0)
+            q.search()
+            with open(prom.format(pid=os.getpid())) as metrics:
+                text = metrics.read()
+            self.assertIn('progress_count{name="Queens",pid="%d"} ' % os.getpid(), text)
+            self.assertIn('progress_fraction_complete{', text)
+            self.assertIn('le="+Inf"} ', text)
+            self.assertIn('status="[1, 3, 5, 0, 2, 4]"} 1', text)
+        finally:
+            Progress.default_sink = None
+            shutil.rmtree(temp_dir)
+
+        self.assertIsNone(make_sink(''))
+        self.assertIs(make_sink('jsonl:x.jsonl'), make_sink('jsonl:x.jsonl'))
+        self.assertRaises(ValueError, make_sink, 'csv:x.csv')
+
+    def test_watch_cancel(self):
+        flag = RawValue('b', 0)
+        q = BacktrackQueens(30)
+        q.watch_cancel(flag, tick_steps=10)
+        flag.value = 1
+        self.assertRaises(SearchCancelled, q.search)
+        self.assertEqual(list(q.iter_solutions()), [])
+
+
 class TestMulti(unittest.TestCase):
     def test_basic(self):
         def on_result(result):
@@ -84,6 +279,76 @@ class TestMulti(unittest.TestCase):
         ms.search(callback=on_result)
         ms.join()
 
+    def test_steal(self):
+        solutions = []
+
+        def on_result(result):
+            solutions.append(tuple(result))
+
+        ms = MultiSearch(searcher=BacktrackQueens, size=8, steal=True, workers=3,
+                         max_solutions=None, steal_interval=10)
+        ms.search(callback=on_result)
+        ms.join()
+        self.assertEqual(len(solutions), 92)
+        self.assertEqual(len(set(solutions)), 92)
+        self.assertEqual([stats['worker'] for stats in ms.worker_stats], [0, 1, 2])
+        self.assertEqual(sum(stats['tasks'] for stats in ms.worker_stats),
+                         8 + sum(stats['splits'] for stats in ms.worker_stats))
+
+    def test_cancel(self):
+        solutions = []
+        ms = MultiSearch(searcher=BacktrackQueens, size=12, steal=True, workers=3,
+                         steal_interval=10)
+        ms.search(callback=solutions.append)
+        ms.join()
+        self.assertTrue(ms.cancelled.value)
+        self.assertEqual(len(solutions), 1)
+        self.assertEqual([stats['worker'] for stats in ms.worker_stats], [0, 1, 2])
+
+        # Remaining prefixes are abandoned once the first solution is reported.
+        solutions = []
+        ms = MultiSearch(searcher=BacktrackQueens, size=12, workers=2)
+        ms.search(callback=solutions.append)
+        ms.join()
+        self.assertTrue(ms.cancelled.value)
+        self.assertEqual(len(solutions), 1)
+
+    def test_estimate_nodes(self):
+        ms = MultiSearch(searcher=BacktrackQueens, size=8, steal=True, workers=1, probes=200,
+                         seed=1)
+        self.assertEqual(ms.children([]), [[i] for i in range(8)])
+        self.assertEqual(ms.children([0, 2]), [[0, 2, 4], [0, 2, 5], [0, 2, 6], [0, 2, 7]])
+        self.assertEqual(ms.estimate_nodes([0, 4, 7, 5, 2, 6, 1, 3]), 1)
+        # There are 2,057 partial placements of non-attacking queens on a chess board.
+        self.assertAlmostEqual(ms.estimate_nodes([]) / 2057, 1.0, delta=0.15)
+
+    def test_adaptive(self):
+        ms = MultiSearch(searcher=BacktrackQueens, size=8, steal=True, workers=3,
+                         max_solutions=None, adaptive=True, task_time=(0.001, 0.002), seed=1)
+        solutions = list(ms.iter_solutions())
+        self.assertEqual(len(set(solutions)), 92)
+        self.assertGreater(ms.plan_stats['tasks'], 8)
+        self.assertGreaterEqual(ms.plan_stats['max_depth'], 2)
+
+        ms = MultiSearch(searcher=BacktrackQueens, size=8, workers=3, adaptive=True,
+                         task_time=(0.001, 0.002), seed=1)
+        solutions = list(ms.iter_solutions())
+        self.assertEqual(len(set(solutions)), len(solutions))
+        self.assertGreater(len(solutions), 8)
+
+    def test_iter_solutions(self):
+        ms = MultiSearch(searcher=BacktrackQueens, size=8, steal=True, workers=3,
+                         max_solutions=None, steal_interval=10)
+        solutions = list(ms.iter_solutions())
+        self.assertEqual(len(set(solutions)), 92)
+
+        ms = MultiSearch(searcher=BacktrackQueens, size=8, workers=3)
+        solutions = list(ms.iter_solutions())
+        self.assertEqual(sorted(solution[0][1] for solution in solutions), range(8))
+
+        ms = MultiSearch(searcher=BacktrackQueens, size=8, steal=True, workers=3)
+        self.assertEqual(len(list(ms.iter_solutions(limit=5))), 5)
+
 
 class Queens(SearchProgress, SearchSpace):
     def __init__(self, size=8, **kwargs):
@@ -140,5 +405,60 @@ class BacktrackQueens(Queens):
         self.diag2.remove(place[0] + place[1])
 
 
+class SubsetSum(SearchProgress, SearchSpace):
+    """ Pick size numbers (in any order - so each subset is reached many ways) adding to target. """
+    def __init__(self, numbers, size, target, **kwargs):
+        super(SubsetSum, self).__init__(**kwargs)
+        self.numbers = numbers
+        self.size = size
+        self.target = target
+        self.picked = []
+        self.total = 0
+
+    def step(self):
+        super(SubsetSum, self).step()
+        i = self.choose(len(self.numbers))
+        if len(self.picked) == self.size or i in self.picked or \
+                self.total + self.numbers[i] > self.target:
+            return
+        self.picked.append(i)
+        self.total += self.numbers[i]
+        self.accept()
+        if len(self.picked) == self.size and self.total == self.target:
+            return [self.numbers[j] for j in self.picked]
+
+    def backtrack(self, choice):
+        self.total -= self.numbers[self.picked.pop()]
+
+    def state_key(self):
+        return frozenset(self.picked)
+
+
+class FailFirstQueens(BacktrackQueens):
+    """ Place a queen in the row with fewest safe columns next (fail-first). """
+    def step(self):
+        super(Queens, self).step()
+        row = self.next_row()
+        place = self.choose_ordered((row, col) for col in range(self.size) if self.is_safe(row, col))
+        if place is None:
+            return
+        self.check(tuple(place))
+        self.queens.append(tuple(place))
+        self.accept()
+        if self.depth == self.size:
+            return sorted(self.queens)
+
+    def next_row(self):
+        free = [(sum(1 for col in range(self.size) if self.is_safe(row, col)), row)
+                for row in range(self.size) if row not in self.rows]
+        return min(free)[1]
+
+    def is_safe(self, row, col):
+        return col not in self.cols and row - col not in self.diag1 and row + col not in self.diag2
+
+    def check_all(self, places):
+        return all(self.check(tuple(place)) for place in places)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+import unittest
+
+from sieve import primes, prime_powers, small_primes
+
+
+def trial_division(n, prime_power=False):
+    result = []
+    for i in range(2, n + 1):
+        factors = [p for p in range(2, i + 1) if i % p == 0 and all(p % d for d in range(2, p))]
+        if len(factors) == 1 and (prime_power or factors[0] == i):
+            result.append(i)
+    return result
+
+
+class TestSieve(unittest.TestCase):
+    def test_small(self):
+        for n in range(0, 130):
+            self.assertEqual(list(primes(n)), trial_division(n))
+            self.assertEqual(list(prime_powers(n)), trial_division(n, prime_power=True))
+            self.assertEqual(small_primes(n), trial_division(n))
+
+    def test_segments(self):
+        expected = list(primes(20000))
+        expected_powers = list(prime_powers(20000))
+        # Segments from a single wheel turn (30 numbers) up.
+        for segment_size in (8, 16, 48, 1000):
+            self.assertEqual(list(primes(20000, segment_size)), expected)
+            self.assertEqual(list(prime_powers(20000, segment_size)), expected_powers)
+
+    def test_counts(self):
+        self.assertEqual(sum(1 for p in primes(10 ** 6)), 78498)
+        self.assertEqual(list(primes(10 ** 6))[-1], 999983)
+        self.assertEqual(sum(1 for p in prime_powers(10 ** 6)), 78734)
+
+    def test_generator(self):
+        numbers = primes(10 ** 12)
+        self.assertEqual([next(numbers) for i in range(10)], [2, 3, 5, 7, 11, 13, 17, 19, 23, 29])
+
+
+if __name__ == '__main__':
+    unittest.main()